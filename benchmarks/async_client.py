@@ -0,0 +1,104 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+'''
+Compares Client (one thread per in-flight composite call) against AsyncClient
+(a single event loop) at increasing concurrency, using a local StubUpstream.
+
+    python3 -m benchmarks.async_client --latency 0.05 --calls 400
+'''
+
+import os
+import sys
+import asyncio
+import logging
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+# The stub upstream speaks plain HTTP
+os.environ.setdefault('OAUTHLIB_INSECURE_TRANSPORT', '1')
+
+from symplpay.client import Client, AsyncClient
+from benchmarks.stub_upstream import StubUpstream
+
+# --HELPER FUNCTIONS ----------------------------------------------------------
+def bench_threads(stub, l, calls, concurrency):
+    '''
+    :return: seconds taken by calls composite calls using concurrency threads
+    '''
+    client = Client('bench', 'bench', stub.base_url, stub.token_url, l, max_in_flight=2)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start = perf_counter()
+        list(executor.map(lambda i: client.composite_users(f'user-{i}', None, None, 'bench'),
+                          range(calls)))
+        return perf_counter() - start
+
+async def bench_asyncio(stub, l, calls, concurrency):
+    '''
+    :return: seconds taken by calls composite calls with at most concurrency
+             of them in flight
+    '''
+    in_flight = asyncio.Semaphore(concurrency)
+    async with AsyncClient('bench', 'bench', stub.base_url, stub.token_url, l,
+                           pool_size=3 * concurrency) as client:
+        async def composite(i):
+            async with in_flight:
+                return await client.composite_users(f'user-{i}', None, None, 'bench')
+
+        # Warm the token before timing, as Client does in its constructor
+        await composite(0)
+        start = perf_counter()
+        await asyncio.gather(*[composite(i) for i in range(calls)])
+        return perf_counter() - start
+
+# --MAIN----------------------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--latency',
+                        help='Seconds each stub upstream GET takes.',
+                        type=float,
+                        default=0.05)
+    parser.add_argument('--calls',
+                        help='Composite calls per measurement.',
+                        type=int,
+                        default=400)
+    parser.add_argument('--concurrency',
+                        help='Concurrency levels to measure.',
+                        type=int,
+                        nargs='+',
+                        default=[1, 10, 50, 100, 200])
+    args = parser.parse_args()
+
+    l = logging.getLogger('bench')
+    l.addHandler(logging.NullHandler())
+    stub = StubUpstream(latency=args.latency).start()
+
+    print(f'{args.calls} composite calls, {args.latency}s upstream latency')
+    print(f'{"concurrency":>12} {"threads (calls/s)":>18} {"asyncio (calls/s)":>18}')
+    for concurrency in args.concurrency:
+        threads = bench_threads(stub, l, args.calls, concurrency)
+        aio = asyncio.run(bench_asyncio(stub, l, args.calls, concurrency))
+        print(f'{concurrency:>12} {args.calls / threads:>18.1f} {args.calls / aio:>18.1f}')
+
+    stub.stop()
@@ -0,0 +1,202 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+'''
+Local stand-in for Redis, speaking just enough of its protocol (RESP2
+or RESP3) for RedisCache: PING, GET, SET (with EX/PX), DEL, SCAN and FLUSHDB. Pipelines
+work as they would against the real thing.
+
+    python3 -m benchmarks.fake_redis --port 6379
+'''
+
+import fnmatch
+import threading
+from argparse import ArgumentParser
+from socketserver import ThreadingTCPServer, StreamRequestHandler
+from time import monotonic
+
+# -----------------------------------------------------------------------------
+class FakeRedis(object):
+    '''
+    In-memory Redis stand-in listening on localhost.
+    '''
+    def __init__(self, port=0):
+        '''
+        Constructor
+        :param port: TCP port to listen on. 0 picks a free one
+        :return: Instance of this class.
+        '''
+        # key -> (expires_at or None, value)
+        self.data = {}
+        self.lock = threading.Lock()
+        # Number of commands answered, keyed by command name
+        self.commands = {}
+
+        fake = self
+        class Handler(StreamRequestHandler):
+            def handle(self):
+                resp3 = False
+                while True:
+                    try:
+                        command = fake.read_command(self.rfile)
+                    except (EOFError, ValueError, OSError):
+                        return
+                    if command[:1] and command[0].upper() == b'HELLO':
+                        resp3 = command[1:2] == [b'3']
+                    self.wfile.write(fake.execute(command, resp3))
+
+        ThreadingTCPServer.allow_reuse_address = True
+        self.server = ThreadingTCPServer(('localhost', port), Handler)
+        self.server.daemon_threads = True
+        self.url = f'redis://localhost:{self.server.server_address[1]}/0'
+
+    def start(self):
+        '''
+        Starts answering commands from a background thread.
+        :return: This instance
+        '''
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        '''
+        :return: Nothing
+        '''
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def read_command(rfile):
+        '''
+        :param rfile: stream to read from
+        :return: list of the command's arguments as bytes
+        '''
+        line = rfile.readline()
+        if not line:
+            raise EOFError()
+        if not line.startswith(b'*'):
+            # Inline command, e.g. typed into telnet
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(rfile.readline()[1:])
+            args.append(rfile.read(length + 2)[:-2])
+        return args
+
+    def execute(self, command, resp3=False):
+        '''
+        :param command: list of the command's arguments as bytes
+        :param resp3: whether the caller switched to RESP3 (see HELLO)
+        :return: encoded reply
+        '''
+        if not command:
+            return b'-ERR empty command\r\n'
+        name = command[0].decode().upper()
+        with self.lock:
+            self.commands[name] = self.commands.get(name, 0) + 1
+            handler = getattr(self, f'_{name.lower()}', None)
+            if handler is None:
+                return f'-ERR unknown command \'{name}\'\r\n'.encode()
+            try:
+                reply = handler(*command[1:])
+            except (TypeError, ValueError):
+                return f'-ERR wrong arguments for \'{name}\'\r\n'.encode()
+        if reply is None:
+            return b'_\r\n' if resp3 else b'$-1\r\n'
+        return reply
+
+    def _hello(self, protover=b'2', *options):
+        fields = [(b'server', b'$5\r\nredis\r\n'), (b'version', b'$5\r\n7.0.0\r\n'),
+                  (b'proto', b':%d\r\n' % int(protover))]
+        # RESP3 clients expect a map, older ones a flat array
+        reply = b'%%%d\r\n' % len(fields) if protover == b'3' else b'*%d\r\n' % (2 * len(fields))
+        return reply + b''.join(b'$%d\r\n%s\r\n%s' % (len(name), name, value) for name, value in fields)
+
+    def _client(self, *options):
+        return b'+OK\r\n'
+
+    def _ping(self):
+        return b'+PONG\r\n'
+
+    def _get(self, key):
+        value = self.__value(key)
+        if value is None:
+            return None
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def _set(self, key, value, *options):
+        expires_at = None
+        options = [option.decode().upper() for option in options]
+        for option, amount in zip(options[::2], options[1::2]):
+            if option == 'EX':
+                expires_at = monotonic() + int(amount)
+            elif option == 'PX':
+                expires_at = monotonic() + int(amount) / 1000
+            else:
+                raise ValueError(option)
+        self.data[key] = (expires_at, value)
+        return b'+OK\r\n'
+
+    def _del(self, *keys):
+        return b':%d\r\n' % sum(self.data.pop(key, None) is not None for key in keys)
+
+    def _scan(self, cursor, *options):
+        # Everything is returned at once, so the cursor is always 0
+        options = [option.decode() for option in options]
+        pattern = dict(zip([o.upper() for o in options[::2]], options[1::2])).get('MATCH', '*')
+        keys = [key for key in list(self.data)
+                if self.__value(key) is not None and fnmatch.fnmatchcase(key.decode(), pattern)]
+        reply = b'*2\r\n$1\r\n0\r\n*%d\r\n' % len(keys)
+        return reply + b''.join(b'$%d\r\n%s\r\n' % (len(key), key) for key in keys)
+
+    def _flushdb(self, *options):
+        self.data.clear()
+        return b'+OK\r\n'
+
+    def __value(self, key):
+        '''
+        :return: value stored under key or None if missing/expired
+        '''
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] <= monotonic():
+            del self.data[key]
+            return None
+        return entry[1]
+
+# --MAIN----------------------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--port',
+                        help='TCP port to listen on.',
+                        type=int,
+                        default=6379)
+    args = parser.parse_args()
+
+    fake = FakeRedis(port=args.port)
+    print(f'Listening on {fake.url}')
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,120 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+'''
+Compares reading a page of upstream credit cards whole (what
+requests.Response.json() does) with parsing it as it's read through
+symplpay.incremental (requires ijson), for pages of increasing size. Both
+end with the same filtered credit cards.
+
+    python3 -m benchmarks.incremental_parsing --results 10 100 1000 10000
+'''
+
+import json
+import tracemalloc
+from argparse import ArgumentParser
+from time import perf_counter
+
+from symplpay.records import records_of, section_results
+from symplpay.incremental import parse_collection, CHUNK_SIZE
+from benchmarks.stub_upstream import StubUpstream
+
+# --HELPER FUNCTIONS ----------------------------------------------------------
+def page_of(results):
+    '''
+    :param results: number of credit cards on the page
+    :return: JSON bytes of a page of credit cards, each carrying the kind of
+             details the upstream sends along which composite results drop
+    '''
+    url = 'http://upstream/users/bench/creditCards'
+    states = StubUpstream.credit_card_states
+    return json.dumps({'totalResults': results, 'results': [
+        {'creditCardId': f'cc-{i}', 'userId': 'bench', 'state': states[i % len(states)],
+         'name': 'Bench Card', 'cardType': 'VISA', 'pan': '############4242',
+         'expMonth': 12, 'expYear': 2030, 'createdTsEpoch': 1600000000000 + i,
+         'address': {'street1': '1035 Pearl St', 'city': 'Boulder', 'state': 'CO',
+                     'postalCode': '80302', 'countryCode': 'US'},
+         'termsAssetReferences': [{'mimeType': 'text/html', '_links': {'self': {'href': f'{url}/cc-{i}/terms'}}}],
+         '_links': {'self': {'href': f'{url}/cc-{i}'}, 'user': {'href': 'http://upstream/users/bench'},
+                    'acceptTerms': {'href': f'{url}/cc-{i}/acceptTerms'},
+                    'transactions': {'href': f'{url}/cc-{i}/transactions'}}}
+        for i in range(results)]}).encode()
+
+def chunks_of(body):
+    '''
+    :param body: bytes
+    :return: generator of body's chunks, one at a time as they'd be read off
+             the network
+    '''
+    return (body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE))
+
+def whole(body):
+    '''
+    :return: ACTIVE credit cards of the page, read whole first
+    '''
+    return section_results(records_of('creditCards', json.loads(b''.join(chunks_of(body)))), 'ACTIVE')
+
+def incremental(body):
+    '''
+    :return: ACTIVE credit cards of the page, parsed as it's read
+    '''
+    return section_results(records_of('creditCards', parse_collection(chunks_of(body))), 'ACTIVE')
+
+def bench(parse, body, repeat):
+    '''
+    :return: tuple of seconds per page and peak bytes allocated parsing one
+    '''
+    start = perf_counter()
+    for _ in range(repeat):
+        parse(body)
+    elapsed = (perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    parse(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+# --MAIN----------------------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--results',
+                        help='Numbers of credit cards per page to measure.',
+                        type=int,
+                        nargs='+',
+                        default=[10, 100, 1000, 10000])
+    parser.add_argument('--repeat',
+                        help='Pages parsed per measurement.',
+                        type=int,
+                        default=20)
+    args = parser.parse_args()
+
+    print(f'{"results":>8} {"page KiB":>9} {"whole ms":>9} {"whole peak KiB":>15}'
+          f' {"incremental ms":>15} {"incremental peak KiB":>21}')
+    for results in args.results:
+        body = page_of(results)
+        assert whole(body) == incremental(body)
+        w = bench(whole, body, args.repeat)
+        i = bench(incremental, body, args.repeat)
+        print(f'{results:>8} {len(body) / 1024:>9.0f} {w[0] * 1000:>9.2f} {w[1] / 1024:>15.0f}'
+              f' {i[0] * 1000:>15.2f} {i[1] / 1024:>21.0f}')
@@ -0,0 +1,126 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+'''
+Forks N worker processes from one parent, as gunicorn does, and has each of
+them look up the same users. Compares workers with caches and tokens of
+their own against workers sharing them through a Sidecar.
+
+    python3 -m benchmarks.shared_state --workers 1 2 4 8 --users 50 --calls 200
+'''
+
+import os
+import random
+import logging
+import tempfile
+from argparse import ArgumentParser
+from time import perf_counter
+
+# The stub upstream speaks plain HTTP
+os.environ.setdefault('OAUTHLIB_INSECURE_TRANSPORT', '1')
+
+from symplpay.client import Client
+from symplpay.cache import TTLCache
+from symplpay.shared import Sidecar, SharedCache, SharedTokenCache
+from benchmarks.stub_upstream import StubUpstream
+
+# --HELPER FUNCTIONS ----------------------------------------------------------
+def bench(stub, l, workers, users, calls, shared):
+    '''
+    :return: tuple of cache hit rate across all workers, number of tokens
+             fetched and seconds taken
+    '''
+    stub.hits.clear()
+    sidecar = None
+    cache = TTLCache(ttl=600, max_entries=users)
+    token_cache = None
+    if shared:
+        sidecar = Sidecar(os.path.join(tempfile.mkdtemp(), 'symplpay.sock'), l, cache).start()
+        cache = SharedCache(sidecar.connect(), l)
+        token_cache = SharedTokenCache(sidecar.connect(), l)
+    # Like gunicorn, build the app once and fork workers off it. Lazy tokens
+    # leave each worker to get its own
+    client = Client('bench', 'bench', stub.base_url, stub.token_url, l,
+                    cache=cache, token_cache=token_cache, lazy_token=True)
+
+    start = perf_counter()
+    pids = []
+    for worker in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                rand = random.Random(worker)
+                for _ in range(calls):
+                    client.composite_users(f'user-{rand.randrange(users)}', None, None, 'bench')
+            except Exception as e:
+                print(f'Worker {worker} failed: {e}')
+                status = 1
+            os._exit(status)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    elapsed = perf_counter() - start
+
+    if sidecar is not None:
+        sidecar.stop()
+    user_gets = sum(hits for path, hits in stub.hits.items() if path.count('/') == 2)
+    tokens = sum(hits for path, hits in stub.hits.items() if path.endswith('/token'))
+    return 1 - user_gets / (workers * calls), tokens, elapsed
+
+# --MAIN----------------------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--latency',
+                        help='Seconds each stub upstream GET takes.',
+                        type=float,
+                        default=0.01)
+    parser.add_argument('--workers',
+                        help='Numbers of worker processes to measure.',
+                        type=int,
+                        nargs='+',
+                        default=[1, 2, 4, 8])
+    parser.add_argument('--users',
+                        help='Distinct users looked up.',
+                        type=int,
+                        default=50)
+    parser.add_argument('--calls',
+                        help='Composite calls per worker.',
+                        type=int,
+                        default=200)
+    args = parser.parse_args()
+
+    l = logging.getLogger('bench')
+    l.addHandler(logging.NullHandler())
+    stub = StubUpstream(latency=args.latency).start()
+
+    print(f'{args.calls} composite calls per worker over {args.users} users, {args.latency}s upstream latency')
+    print(f'{"workers":>8} {"own hit rate":>13} {"own tokens":>11} {"own secs":>9}'
+          f' {"shared hit rate":>16} {"shared tokens":>14} {"shared secs":>12}')
+    for workers in args.workers:
+        own = bench(stub, l, workers, args.users, args.calls, False)
+        shared = bench(stub, l, workers, args.users, args.calls, True)
+        print(f'{workers:>8} {own[0]:>13.1%} {own[1]:>11} {own[2]:>9.2f}'
+              f' {shared[0]:>16.1%} {shared[1]:>14} {shared[2]:>12.2f}')
+
+    stub.stop()
@@ -0,0 +1,182 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+import json
+import hashlib
+import threading
+from time import sleep
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+# -----------------------------------------------------------------------------
+class StubUpstream(object):
+    '''
+    Local stand-in for the remote REST API (and its token endpoint) used by
+    the benchmarks. Every GET sleeps for latency seconds to mimic a real
+    network round trip.
+    '''
+    credit_card_states = ['ACTIVE', 'DEACTIVATED', 'PENDING_VERIFICATION']
+    device_states = ['INITIALIZED', 'DISCONNECTED']
+
+    def __init__(self, latency=0.05, num_results=5, port=0, etags=True, page_size=None):
+        '''
+        Constructor
+        :param latency: time in seconds each GET takes to answer
+        :param num_results: number of credit cards and devices per user
+        :param port: TCP port to listen on. 0 picks a free one
+        :param etags: send ETags and honor If-None-Match
+        :param page_size: default number of credit cards or devices per page
+                          when the caller doesn't give a "limit". None
+                          answers with all of them
+        :return: Instance of this class.
+        '''
+        self.latency = latency
+        self.num_results = num_results
+        self.etags = etags
+        self.page_size = page_size
+        # Number of GETs (and token POSTs) answered, keyed by path
+        self.hits = {}
+        self.hits_lock = threading.Lock()
+
+        stub = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                path = urlsplit(self.path).path
+                with stub.hits_lock:
+                    stub.hits[path] = stub.hits.get(path, 0) + 1
+                self.send_json(200, {'access_token': 'stub', 'token_type': 'bearer', 'expires_in': 3600})
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                path = parts.path
+                with stub.hits_lock:
+                    stub.hits[path] = stub.hits.get(path, 0) + 1
+                sleep(stub.latency)
+                query = {name: values[0] for name, values in parse_qs(parts.query).items()}
+                status, body = stub.route(f'http://{self.headers["Host"]}', path, query)
+                self.send_json(status, body, etag=stub.etags)
+
+            def send_json(self, status, body, etag=False):
+                body = json.dumps(body).encode()
+                tag = f'"{hashlib.md5(body).hexdigest()}"' if etag and status == 200 else None
+                if tag is not None and self.headers.get('If-None-Match') == tag:
+                    status, body = 304, b''
+                self.send_response(status)
+                if tag is not None:
+                    self.send_header('ETag', tag)
+                if status != 304:
+                    self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('localhost', port), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f'http://localhost:{self.server.server_address[1]}'
+        self.token_url = f'{self.base_url}/oauth/token?grant_type=client_credentials'
+
+    def route(self, base_url, path, query=None):
+        '''
+        :param base_url: URL the caller used to reach us
+        :param path: path of the GET request
+        :param query: dictionary of the GET request's query. Collections are
+                      paged by its "offset" and "limit" and narrowed down
+                      by its comma-separated "excludeState"
+        :return: tuple of HTTP status and JSON body
+        '''
+        parts = path.strip('/').split('/')
+        if parts[0] != 'users' or len(parts) not in (2, 3) or parts[1] == 'does-not-exist':
+            return 404, {'errors': [{'message': 'Not found'}]}
+
+        user_url = f'{base_url}/users/{parts[1]}'
+        if len(parts) == 2:
+            return 200, {'id': parts[1],
+                         '_links': {'self': {'href': user_url},
+                                    'creditCards': {'href': f'{user_url}/creditCards'},
+                                    'devices': {'href': f'{user_url}/devices'}}}
+        elif parts[2] == 'creditCards':
+            results = [{'creditCardId': f'cc-{i}',
+                        'state': self.credit_card_states[i % len(self.credit_card_states)],
+                        'name': 'Stub Card', 'cardType': 'VISA',
+                        '_links': {'self': {'href': f'{user_url}/creditCards/cc-{i}'}}}
+                       for i in range(self.num_results)]
+        elif parts[2] == 'devices':
+            results = [{'deviceIdentifier': f'device-{i}',
+                        'state': self.device_states[i % len(self.device_states)],
+                        'deviceName': 'Stub Device', 'manufacturerName': 'Stub',
+                        '_links': {'self': {'href': f'{user_url}/devices/device-{i}'}}}
+                       for i in range(self.num_results)]
+        else:
+            return 404, {'errors': [{'message': 'Not found'}]}
+        excluded = set((query or {}).get('excludeState', '').split(','))
+        results = [x for x in results if x['state'] not in excluded]
+        return 200, self.page(f'{user_url}/{parts[2]}', results, query or {})
+
+    def page(self, url, results, query):
+        '''
+        :param url: URL of the collection
+        :param results: every result in the collection
+        :param query: see route
+        :return: JSON body of the requested page, linking to the next one
+        '''
+        limit = query.get('limit', self.page_size)
+        if limit is None:
+            return {'totalResults': len(results), 'results': results}
+        offset, limit = int(query.get('offset', 0)), int(limit)
+        # Links keep whatever else the query narrowed things down by
+        link = lambda offset: f'{url}?{urlencode(dict(query, offset=offset, limit=limit))}'
+        body = {'totalResults': len(results), 'offset': offset, 'limit': limit,
+                'results': results[offset:offset + limit],
+                '_links': {'self': {'href': link(offset)}}}
+        if offset + limit < len(results):
+            body['_links']['next'] = {'href': link(offset + limit)}
+        return body
+
+    def start(self):
+        '''
+        Starts answering requests from a background thread.
+        :return: This instance
+        '''
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        '''
+        :return: Nothing
+        '''
+        self.server.shutdown()
+        self.server.server_close()
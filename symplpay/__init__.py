@@ -22,10 +22,21 @@
 # SOFTWARE.
 # -----------------------------------------------------------------------------
 
+import json
 import logging
 import logging.handlers
 import sys
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 # --SANITY CHECKS--------------------------------------------------------------
 if sys.version_info.major != 3:
     print("This version of Python, {{sys.version}}, is not supported! Please install 3.x!")
@@ -61,3 +72,25 @@ l.addHandler(_pbh)
 l.pbh = _pbh
 
 # --HELPER FUNCTIONS ----------------------------------------------------------
+def json_encoder(name='auto'):
+    '''
+    Picks a JSON encoder. orjson and ujson are several times faster than
+    Python's own json module, but optional.
+    :param name: "orjson", "ujson", "json" or "auto" for the fastest one
+                 installed
+    :return: function encoding an object to JSON bytes
+    '''
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'ujson' if ujson is not None else 'json'
+
+    if name == 'orjson':
+        if orjson is None:
+            raise ImportError('The "orjson" package is unavailable. Please run "pip install orjson".')
+        return orjson.dumps
+    elif name == 'ujson':
+        if ujson is None:
+            raise ImportError('The "ujson" package is unavailable. Please run "pip install ujson".')
+        return lambda obj: ujson.dumps(obj, escape_forward_slashes=False).encode()
+    elif name == 'json':
+        return lambda obj: json.dumps(obj).encode()
+    raise ValueError(f'Unknown JSON encoder "{name}"!')
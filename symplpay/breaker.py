@@ -0,0 +1,229 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+import threading
+from time import monotonic
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+# -----------------------------------------------------------------------------
+class CircuitOpenError(HTTPError):
+    '''
+    Raised instead of calling an endpoint whose circuit breaker is open.
+    Surfaces as a 503 to our own callers.
+    '''
+    def __init__(self, url, endpoint):
+        '''
+        Constructor
+        :param url: URL which was not called
+        :param endpoint: name of the endpoint's circuit breaker
+        :return: Instance of this class.
+        '''
+        super().__init__(url, 503, f'Circuit breaker for {endpoint} is open!', None, None)
+
+# -----------------------------------------------------------------------------
+class CircuitBreaker(object):
+    '''
+    Classic closed/open/half-open circuit breaker.
+    While closed, calls go through and their outcomes are tallied over a
+    sliding window. Too many failures or slow calls open the breaker, which
+    then rejects every call for open_for seconds. After that, up to
+    half_open_calls trial calls are let through: if all of them succeed the
+    breaker closes again, otherwise it re-opens.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, error_rate=0.5, slow_call=5, slow_rate=0.5, min_calls=20,
+                 window=30, open_for=30, half_open_calls=3, clock=monotonic):
+        '''
+        Constructor
+        :param name: what the breaker protects. Used in logs and errors
+        :param error_rate: fraction of failed calls which opens the breaker
+        :param slow_call: time in seconds after which a call counts as slow
+        :param slow_rate: fraction of slow calls which opens the breaker
+        :param min_calls: calls needed within the window before the breaker
+                          may open
+        :param window: time in seconds call outcomes are remembered for
+        :param open_for: time in seconds the breaker stays open
+        :param half_open_calls: number of trial calls made while half-open
+        :param clock: function returning the current time in seconds
+        :return: Instance of this class.
+        '''
+        self.name = name
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_for = open_for
+        self.half_open_calls = half_open_calls
+        self.clock = clock
+
+        self.state = self.CLOSED
+        self.opened_at = None
+        # whole second -> [calls, failures, slow calls]
+        self.buckets = {}
+        self.trials = 0
+        self.trial_successes = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        '''
+        Must be followed by either record or abandon when True is returned.
+        :return: True if a call may go ahead
+        '''
+        with self.lock:
+            if self.state == self.OPEN and self.clock() >= self.opened_at + self.open_for:
+                self.state = self.HALF_OPEN
+                self.trials = 0
+                self.trial_successes = 0
+
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and self.trials < self.half_open_calls:
+                self.trials += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, success, latency):
+        '''
+        Records the outcome of an allowed call.
+        :param success: False if the call failed
+        :param latency: time in seconds the call took
+        :return: Nothing
+        '''
+        slow = latency >= self.slow_call
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                if success and not slow:
+                    self.trial_successes += 1
+                    if self.trial_successes >= self.half_open_calls:
+                        self.state = self.CLOSED
+                        self.buckets.clear()
+                else:
+                    self.__open()
+                return
+
+            bucket = self.__bucket()
+            bucket[0] += 1
+            bucket[1] += not success
+            bucket[2] += slow
+            if self.state == self.CLOSED:
+                calls, failures, slow_calls = [sum(x[i] for x in self.buckets.values()) for i in range(3)]
+                if calls >= self.min_calls and (failures >= self.error_rate * calls or
+                                                slow_calls >= self.slow_rate * calls):
+                    self.__open()
+
+    def abandon(self):
+        '''
+        Gives back an allowed call which never reached the endpoint.
+        :return: Nothing
+        '''
+        with self.lock:
+            if self.state == self.HALF_OPEN and self.trials > 0:
+                self.trials -= 1
+
+    def stats(self):
+        '''
+        :return: dictionary of counters suitable for monitoring
+        '''
+        with self.lock:
+            self.__bucket()
+            calls, failures, slow_calls = [sum(x[i] for x in self.buckets.values()) for i in range(3)]
+            return {
+                'state': self.state,
+                'calls': calls,
+                'failures': failures,
+                'slowCalls': slow_calls,
+                'rejected': self.rejected
+            }
+
+    def __open(self):
+        '''
+        Must be called with the lock held.
+        :return: Nothing
+        '''
+        self.state = self.OPEN
+        self.opened_at = self.clock()
+
+    def __bucket(self):
+        '''
+        Must be called with the lock held.
+        :return: counters for the current second, dropping expired ones
+        '''
+        now = int(self.clock())
+        for second in [x for x in self.buckets if x <= now - self.window]:
+            del self.buckets[second]
+        return self.buckets.setdefault(now, [0, 0, 0])
+
+# -----------------------------------------------------------------------------
+class CircuitBreakers(object):
+    '''
+    One CircuitBreaker per REMOTE endpoint, created on demand.
+    '''
+    def __init__(self, **kwargs):
+        '''
+        Constructor
+        :param kwargs: passed on to every CircuitBreaker
+        :return: Instance of this class.
+        '''
+        self.kwargs = kwargs
+        # endpoint -> CircuitBreaker
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def for_url(self, url):
+        '''
+        :param url: REMOTE URL about to be called
+        :return: CircuitBreaker of the URL's endpoint
+        '''
+        name = endpoint(url)
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.setdefault(name, CircuitBreaker(name, **self.kwargs))
+        return breaker
+
+    def stats(self):
+        '''
+        :return: dictionary of every breaker's counters, keyed by endpoint
+        '''
+        return {name: breaker.stats() for name, breaker in list(self.breakers.items())}
+
+# --HELPER FUNCTIONS ----------------------------------------------------------
+def endpoint(url):
+    '''
+    REST paths alternate between collections and IDs, e.g.
+    /users/{userId}/creditCards, so every other path segment is an ID.
+    :param url: REMOTE URL
+    :return: the URL's host and path with IDs blanked out
+    '''
+    parts = urlsplit(url)
+    segments = parts.path.strip('/').split('/')
+    path = '/'.join('{id}' if i % 2 else x for i, x in enumerate(segments))
+    return f'{parts.netloc}/{path}'
@@ -0,0 +1,197 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+# -----------------------------------------------------------------------------
+class CacheBackend(object):
+    '''
+    What Client expects of its cache. Entries go stale ttl seconds after
+    they're stored and are dropped grace seconds later; see lookup.
+    Implementations must be thread-safe.
+    '''
+    grace = 0
+    # Whether lookups hand back the very objects stored, rather than copies
+    in_process = False
+
+    def get(self, key):
+        '''
+        :param key: cache key
+        :return: cached value or None if missing/stale
+        '''
+        value, stale = self.lookup(key)
+        return None if stale else value
+
+    def lookup(self, key):
+        '''
+        Like get, but also hands back entries which went stale less than
+        grace seconds ago so callers can serve them while revalidating.
+        :param key: cache key
+        :return: tuple of cached value (None if missing) and whether it's stale
+        '''
+        raise NotImplementedError
+
+    def lookup_many(self, keys):
+        '''
+        lookup for several keys at once. Backends living elsewhere override
+        it to save round trips.
+        :param keys: list of cache keys
+        :return: list of lookup results in the same order as keys
+        '''
+        return [self.lookup(key) for key in keys]
+
+    def set(self, key, value):
+        '''
+        :param key: cache key
+        :param value: anything but None
+        :return: Nothing
+        '''
+        raise NotImplementedError
+
+    def invalidate(self, key):
+        '''
+        :param key: cache key to drop. Missing keys are ignored
+        :return: Nothing
+        '''
+        raise NotImplementedError
+
+    def clear(self):
+        '''
+        Drops every entry.
+        :return: Nothing
+        '''
+        raise NotImplementedError
+
+    def stats(self):
+        '''
+        :return: dictionary of counters suitable for monitoring
+        '''
+        return {}
+
+# -----------------------------------------------------------------------------
+class TTLCache(CacheBackend):
+    '''
+    Bounded, thread-safe, in-process cache.
+    Entries expire ttl seconds after they're stored and the least recently
+    used entry is evicted whenever max_entries would be exceeded.
+    '''
+    in_process = True
+
+    def __init__(self, ttl=60, max_entries=1024, grace=0, clock=monotonic):
+        '''
+        Constructor
+        :param ttl: time in seconds an entry stays fresh for
+        :param max_entries: maximum number of entries held at once
+        :param grace: time in seconds an entry is kept around after going
+                      stale. See lookup
+        :param clock: function returning the current time in seconds
+        :return: Instance of this class.
+        '''
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.grace = grace
+        self.clock = clock
+
+        # key -> (fresh_until, value), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def lookup(self, key):
+        '''
+        See CacheBackend.lookup
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            now = self.clock()
+            if entry is not None and entry[0] + self.grace <= now:
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None, False
+
+            self.entries.move_to_end(key)
+            if entry[0] <= now:
+                self.stale_hits += 1
+                return entry[1], True
+            self.hits += 1
+            return entry[1], False
+
+    def set(self, key, value):
+        '''
+        Stores value under key, evicting the least recently used entry if the
+        cache is full.
+        :param key: cache key
+        :param value: anything but None
+        :return: Nothing
+        '''
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        '''
+        :param key: cache key to drop. Missing keys are ignored
+        :return: Nothing
+        '''
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        '''
+        Drops every entry.
+        :return: Nothing
+        '''
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        '''
+        :return: dictionary of counters suitable for monitoring
+        '''
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'maxEntries': self.max_entries,
+                'ttl': self.ttl,
+                'grace': self.grace,
+                'hits': self.hits,
+                'staleHits': self.stale_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
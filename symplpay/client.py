@@ -23,10 +23,29 @@
 # -----------------------------------------------------------------------------
 
 import sys
-from time import sleep
+import os
+import hashlib
+from time import sleep, monotonic
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import urllib
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from symplpay import json_encoder
+from symplpay.cache import TTLCache
+from symplpay.singleflight import SingleFlight
+from symplpay.retry import RetryPolicy
+from symplpay.breaker import CircuitOpenError
+from symplpay.deadline import Deadline, DeadlineExceeded
+from symplpay.transport import PoolingAdapter
+from symplpay.token import TokenManager
+from symplpay.states import ObservedStates
+from symplpay import incremental
+from symplpay.records import User, composite, records_of, section_results
 
 try:
+    import requests
     from oauthlib.oauth2 import BackendApplicationClient, TokenExpiredError
     from requests_oauthlib import OAuth2Session
 except ImportError as e:
@@ -34,6 +53,112 @@ except ImportError as e:
     print('Please run "pip install requests_oauthlib" and try starting the server again;)')
     sys.exit(1)
 
+try:
+    import aiohttp
+except ImportError:
+    # Only needed by AsyncClient
+    aiohttp = None
+
+# --GLOBALS--------------------------------------------------------------------
+# Sections of a composite result, each backed by a REMOTE call of its own.
+# Named after both the composite keys and the user's "_links"
+SECTIONS = ('creditCards', 'devices')
+# Most pages read of a single REMOTE collection, in case it keeps handing
+# out more
+MAX_PAGES = 1000
+
+# --HELPER FUNCTIONS ----------------------------------------------------------
+def sections_for(fields):
+    '''
+    :param fields: names of the composite sections wanted (see SECTIONS) or
+                   None for all of them
+    :return: tuple of the sections wanted, in SECTIONS order
+    :raises ValueError: on unknown fields
+    '''
+    if fields is None:
+        return SECTIONS
+    unknown = set(fields) - set(SECTIONS)
+    if unknown:
+        raise ValueError(f'Unknown fields {sorted(unknown)}! Choose from {list(SECTIONS)}.')
+    return tuple(section for section in SECTIONS if section in fields)
+
+def normalize_state(state):
+    '''
+    Normalizes a credit card or device state filter.
+    :param state: state as given by the caller. Ignored if None
+    :return: upper-cased, stripped state or None
+    '''
+    if state is not None:
+        state = state.upper().strip()
+    return state
+
+def with_query(url, **params):
+    '''
+    :param url: URL, possibly with a query already
+    :param params: query parameters to add or replace
+    :return: url with params in its query
+    '''
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query, keep_blank_values=True))
+    query.update((name, str(value)) for name, value in params.items())
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+def next_page_url(url, page):
+    '''
+    :param url: URL page was pulled from
+    :param page: JSON page of a REMOTE collection
+    :return: URL of the following page or None if page was the last one.
+             Follows the "next" link if there is one, else works it out from
+             the page's "offset", "limit" and "totalResults". Only pages
+             echoing the offset asked for are taken to honor offsets at all
+    '''
+    links = page.get('_links') or {}
+    if 'next' in links:
+        next_url = links['next']['href']
+        return None if next_url == url else next_url
+    results = page.get('results') or []
+    if not results or 'offset' not in page or 'totalResults' not in page:
+        return None
+    try:
+        offset = int(dict(parse_qsl(urlsplit(url).query)).get('offset', 0))
+    except ValueError:
+        return None
+    if page['offset'] != offset:
+        return None
+    end = offset + len(results)
+    if end >= page['totalResults']:
+        return None
+    return with_query(url, offset=end, limit=page.get('limit') or len(results))
+
+def excluding(url, states):
+    '''
+    :param url: URL of a REMOTE collection
+    :param states: list of states to leave out or None
+    :return: url narrowed down by the REMOTE "excludeState" query parameter
+    '''
+    return url if not states else with_query(url, excludeState=','.join(states))
+
+def merge_pages(pages):
+    '''
+    :param pages: non-empty list of JSON pages of a REMOTE collection
+    :return: JSON result shaped like a single page holding every result
+    '''
+    if len(pages) == 1:
+        return pages[0]
+    results = [x for page in pages for x in page.get('results') or []]
+    collection = dict(pages[0], results=results, totalResults=len(results))
+    # Links of the first page don't apply to the whole
+    collection.pop('_links', None)
+    return collection
+
+def linked_urls(user_json, sections=SECTIONS):
+    '''
+    :param user_json: /users/{userId} result
+    :param sections: sections to return the URLs of
+    :return: list of the user's credit card and/or device URLs
+    '''
+    return [user_json['_links'][section]['href'] for section in sections]
+
 # -----------------------------------------------------------------------------
 class Client(object):
     '''
@@ -43,7 +168,13 @@ class Client(object):
     def __init__(self, 
                  client_id, client_secret, base_url, token_url,
                  l, 
-                 max_retries=3, retry_sleep=1):
+                 max_retries=3, retry_sleep=1, max_in_flight=1,
+                 max_workers=None, speculative=False, cache=None,
+                 coalesce=True, retry_policy=None, breakers=None, hedge_policy=None,
+                 pool_maxsize=10, pool_block=False, keep_alive=True, prewarm=0,
+                 token_refresh_margin=60, token_cache=None, lazy_token=False, json_dumps=None,
+                 etag_cache_size=0, page_size=None, exclude_states=False, states_ttl=3600,
+                 incremental_json=False, pool_connections=10):
         '''
         Constructor
         :param client_id: REST API username for base_url
@@ -53,9 +184,72 @@ class Client(object):
         :param l: Python logger
         :param max_retries: if we timeout or otherwise fail to invoke an API,
                             this is the maximum number of retry attempts we'll
-                            make
-        :param retry_sleep: time in seconds we sleep between retry attempts
+                            make. Ignored if retry_policy is given
+        :param retry_sleep: time in seconds we sleep before the first retry,
+                            backing off exponentially after that. Ignored if
+                            retry_policy is given
+        :param max_in_flight: maximum number of upstream requests a single
+                              composite call may have outstanding at once.
+                              1 issues them strictly one after another
+        :param max_workers: size of the thread pools shared by all composite
+                            calls for concurrent upstream requests (and
+                            hedging). None lets concurrent.futures pick
+        :param speculative: guess the credit card and device URLs from
+                            base_url and fetch them alongside the user
+                            rather than waiting on the user's "_links"
+        :param cache: optional symplpay.cache.TTLCache holding the unfiltered
+                      REMOTE results for each user ID. Entries within the
+                      cache's grace window are served stale while being
+                      refreshed in the background
+        :param coalesce: let concurrent requests for the same URL share a
+                         single upstream call and its result
+        :param retry_policy: symplpay.retry.RetryPolicy deciding whether and
+                             when failed upstream calls are retried
+        :param breakers: optional symplpay.breaker.CircuitBreakers guarding
+                         each REMOTE endpoint. Calls to an endpoint whose
+                         breaker is open fail fast with a 503
+        :param hedge_policy: optional symplpay.hedge.HedgePolicy. Slow GETs
+                             are duplicated, the duplicate standing in for
+                             a GET which fails
+        :param pool_maxsize: maximum number of pooled connections per host
+        :param pool_block: never open more than pool_maxsize connections per
+                           host, waiting for a pooled one instead
+        :param pool_connections: number of hosts to keep connection pools
+                                 for. Raise it when base_url redirects or
+                                 links to more hosts than that
+        :param keep_alive: send TCP keep-alive probes on idle pooled connections
+        :param prewarm: number of connections to base_url to open up front
+        :param token_refresh_margin: time in seconds ahead of expiry the token
+                                     is refreshed in the background. 0 only
+                                     refreshes once it has expired
+        :param token_cache: optional FileTokenCache letting processes reuse
+                            each other's tokens
+        :param lazy_token: don't wait for the first token. The first calls
+                           block until it arrives instead
+        :param json_dumps: function encoding composite results to JSON bytes.
+                           Defaults to the fastest encoder installed
+        :param etag_cache_size: number of REMOTE results kept along with their
+                                ETag, so they can be revalidated with
+                                If-None-Match rather than downloaded again.
+                                Results are kept as the REMOTE server sent
+                                them for up to a day. 0 (the default)
+                                disables conditional requests
+        :param page_size: number of credit cards or devices to ask the REMOTE
+                          server for per page. None leaves it up to the
+                          server. Either way, every page is read
+        :param exclude_states: have the REMOTE server leave out the credit
+                               cards and devices in states other than the
+                               one wanted, using the states seen so far.
+                               Only applies to results which aren't cached,
+                               as cache entries must hold every state
+        :param states_ttl: time in seconds the states seen are trusted for
+                           before being relearned in the background
+        :param incremental_json: parse credit card and device results as
+                                 they're read, keeping only the fields
+                                 composite results are made of. Requires
+                                 the ijson package
         :return: Instance of this class.
+        :raises ImportError: if incremental_json is set without ijson installed
         '''
         self.client_id = client_id
         self.client_secret = client_secret
@@ -65,11 +259,90 @@ class Client(object):
 
         self.max_retries = max_retries
         self.retry_sleep = retry_sleep
+        self.retry_policy = retry_policy
+        if self.retry_policy is None:
+            self.retry_policy = RetryPolicy(max_attempts=max_retries, base_sleep=retry_sleep)
+        self.breakers = breakers
+        self.hedge_policy = hedge_policy
+
+        self.max_in_flight = max_in_flight
+        self.speculative = speculative
+        self.cache = cache
+        self.json_dumps = json_dumps or json_encoder()
+        # (user_id, states, given_url, sections) -> (REMOTE results, encoded composite, ETag)
+        self.encodings = None
+        if cache is not None and cache.in_process:
+            self.encodings = TTLCache(cache.ttl + cache.grace, cache.max_entries)
+        # URL -> (ETag, JSON result). Entries are revalidated on every use,
+        # so they can be kept around for long
+        self.etags = TTLCache(24 * 60 * 60, etag_cache_size) if etag_cache_size > 0 else None
+        self.page_size = page_size
+        # Parses streamed collection responses or None to read them whole
+        self.parse_collection = None
+        if incremental_json:
+            incremental.check_available()
+            self.parse_collection = incremental.parse_response
+        self.states = None
+        if exclude_states:
+            self.states = ObservedStates(l, lambda section, url: self.__get_collection(url), states_ttl)
+        self.flights = SingleFlight() if coalesce else None
+        # User IDs with a background refresh queued or running
+        self.refreshing = set()
+        self.refreshing_lock = threading.Lock()
+        self.refresher = None
+        self.hedger = None
+        if self.hedge_policy is not None:
+            self.hedger = ThreadPoolExecutor(max_workers=max_workers,
+                                             thread_name_prefix='symplpay-hedge')
+        if self.cache is not None and self.cache.grace > 0:
+            self.refresher = ThreadPoolExecutor(max_workers=max_workers,
+                                                thread_name_prefix='symplpay-refresh')
+        # Shared by all composite calls. max_in_flight is enforced per call
+        # in __get_all_json, not by the size of this pool
+        self.executor = None
+        if self.max_in_flight > 1 or self.speculative:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                               thread_name_prefix='symplpay')
         
-        self.__assign_token()
+        # The session (and its pooled connections) lives as long as we do.
+        # Only its token is ever replaced
+        self.client = BackendApplicationClient(client_id=self.client_id)
+        self.token = None
+        self.pool_args = {'pool_connections': pool_connections, 'pool_maxsize': pool_maxsize,
+                          'pool_block': pool_block, 'keep_alive': keep_alive}
+        self.__new_sessions()
+        if hasattr(os, 'register_at_fork'):
+            # Forked workers (e.g. gunicorn's) must not share our pooled sockets
+            os.register_at_fork(after_in_child=self.__after_fork)
+        self.tokens = TokenManager(self.__fetch_token, l, token_refresh_margin, cache=token_cache,
+                                   on_token=self.__install_token).start(lazy=lazy_token)
+        if prewarm > 0:
+            if lazy_token:
+                threading.Thread(target=self.prewarm, args=(prewarm,), daemon=True).start()
+            else:
+                self.prewarm(prewarm)
+
+    def prewarm(self, connections):
+        '''
+        Opens connections to base_url ahead of the first composite calls so
+        they don't pay for TCP/TLS handshakes.
+        :param connections: number of connections to open
+        :return: Nothing
+        '''
+        self.l.debug(f'Pre-warming {connections} connections to {self.base_url}.')
+        self.tokens.current()
+        def head(_):
+            try:
+                self.session.head(self.base_url, timeout=10)
+            except Exception as e:
+                self.l.error(f'Failed to pre-warm a connection to {self.base_url}: {e}')
+
+        # Concurrent requests can't share a connection, so each opens its own
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            list(executor.map(head, range(connections)))
 
     def composite_users(self, user_id, credit_card_state, device_state,
-                        given_url, user_id_uri='/users/%s'):
+                        given_url, user_id_uri='/users/%s', timeout=None, fields=None):
         '''
         Issues the three related API calls, merging the results
         into a single dictionary which can easily be converted to JSON
@@ -84,6 +357,11 @@ class Client(object):
                           to the caller
         :param user_id_uri: partial path of the REST API URL used to grab info
                             about a particular user
+        :param timeout: time in seconds the three REMOTE calls, including
+                        their retries, must be done in. None waits forever
+        :param fields: sections of the result wanted (see SECTIONS). The
+                       REMOTE calls behind the others are skipped. None
+                       wants them all
         :return: JSON result combining individual results from the three REMOTE
         calls. Follows this pattern:
         {
@@ -94,7 +372,6 @@ class Client(object):
           },
           "userId": "<user_id>",
           "creditCards": {
-            "totalResults": <lenth of results>,
             "results": [
               {
                 "creditCardId": "<credit card unique ID (GUID)>",
@@ -105,10 +382,10 @@ class Client(object):
                     }
                 }
               }
-            ]
+            ],
+            "totalResults": <lenth of results>
           },
           "devices": {
-            "totalResults": <length of results>,
             "results": [
               {
                 "deviceId": "<device unique ID (GUID)>",
@@ -119,116 +396,859 @@ class Client(object):
                   }
                 }
               }
-            ]
+            ],
+            "totalResults": <length of results>
           }
         }
         '''
-        ret_val = {
-            '_links': {
-                'self': {
-                    'href': given_url
-                    }
-                }
-        }
-
         # Normalize parameters
-        if credit_card_state is not None:
-            credit_card_state = credit_card_state.upper().strip()
-        if device_state is not None:
-            device_state = device_state.upper().strip()
+        credit_card_state = normalize_state(credit_card_state)
+        device_state = normalize_state(device_state)
+
+        sections = sections_for(fields)
+        documents = self.__get_cached_documents(user_id, user_id_uri, timeout, sections,
+                                                (credit_card_state, device_state))
+        return composite(documents, sections, credit_card_state, device_state, given_url)
+
+    def composite_users_json(self, user_id, credit_card_state, device_state,
+                             given_url, user_id_uri='/users/%s', timeout=None, fields=None):
+        '''
+        composite_users, encoded as JSON bytes ready to be written out as-is.
+        With an in-process cache, encodings (and their ETags) are cached too
+        and reused for as long as the REMOTE results they came from are.
+
+        :param user_id: see composite_users
+        :param credit_card_state: see composite_users
+        :param device_state: see composite_users
+        :param given_url: see composite_users
+        :param user_id_uri: see composite_users
+        :param timeout: see composite_users
+        :param fields: see composite_users
+        :return: tuple of JSON encoded bytes and their strong ETag
+        '''
+        credit_card_state = normalize_state(credit_card_state)
+        device_state = normalize_state(device_state)
+
+        sections = sections_for(fields)
+        documents = self.__get_cached_documents(user_id, user_id_uri, timeout, sections,
+                                                (credit_card_state, device_state))
+        return self.__encode(user_id, documents, sections, credit_card_state, device_state, given_url)
+
+    def iter_composite_users_json(self, user_id, credit_card_state, device_state,
+                                  given_url, user_id_uri='/users/%s', timeout=None, fields=None):
+        '''
+        composite_users_json, written out a piece at a time. On a cache miss,
+        the credit cards and devices are filtered and encoded page by page as
+        the REMOTE pages arrive, so the first bytes go out as soon as the user
+        is known and large collections are never held in one piece. Sections
+        are read one after the other to keep the output in order. Cache hits
+        come out in a single piece, but misses are left for composite_users
+        and friends to cache since nothing is kept of them here.
+
+        The REMOTE user call is made before returning, so failures up to then
+        are raised here. Later failures are raised by the generator, part way
+        through the output.
 
+        :param user_id: see composite_users
+        :param credit_card_state: see composite_users
+        :param device_state: see composite_users
+        :param given_url: see composite_users
+        :param user_id_uri: see composite_users
+        :param timeout: see composite_users
+        :param fields: see composite_users
+        :return: generator of JSON encoded bytes making up one composite result
+        '''
+        credit_card_state = normalize_state(credit_card_state)
+        device_state = normalize_state(device_state)
+
+        sections = sections_for(fields)
         user_id_uri = f'{self.base_url}{user_id_uri % user_id}'
-        self.l.debug(f'User ID URL is {user_id_uri}')
+        documents, stale = self.__lookup(user_id)
+        if documents is not None and all(documents.section(section) is not None for section in sections):
+            if stale:
+                self.__refresh(user_id, user_id_uri)
+            body, _ = self.__encode(user_id, documents, sections, credit_card_state, device_state, given_url)
+            return iter((body,))
 
-        user_json = self.__get_json(user_id_uri)
-        
-        # In theory, we could just take what was passed as a parameter...
-        # Could also be the case the API normalized the user ID somehow
-        # though;)
-        ret_val['userId'] = user_json['id']
-
-        credit_cards_url = user_json['_links']['creditCards']['href']
-        # Note, while we could use pagination here, I think it's fair to say a
-        # single user is going to have a *reasonable* number of credit cards.
-        #
-        # Also, although /users/{userId}/creditCards does provide an "excludeState"
-        # param, it doesn't include an "includeState". Translation: to perform the
-        # filter server-side one would need to either maintain a hard-coded list
-        # here of all credit card states (BAD IDEA - states can be added/renamed 
-        # over time) *or* invoke a REST API method to obtain this info (BAD IDEA -
-        # to be on the safe side, you'd need to invoke it every time this function is
-        # called and it's not worth it when there are small numbers of credit 
-        # cards associated with each user).  Instead, I simply use a Python list
-        # comprehension on the JSON pulled from the remote server to filter them out.
-        credit_cards_json = self.__get_json(credit_cards_url)
-        credit_cards = [ {'creditCardId': x['creditCardId'], 
-                          'state': x['state'],
-                          '_links': {'self': {'href': x['_links']['self']['href']}}} for x in credit_cards_json['results']
-                          if credit_card_state is None or x['state'].upper().strip() == credit_card_state]
-        # Intentionally do not include "offset" and "limit" as this REST API 
-        # does not support pagination nor should it due to the explaination 
-        # above regarding few CCs/user.
-        ret_val['creditCards'] = {
-            'totalResults': len(credit_cards),
-            'results': credit_cards
-        }
+        deadline = None if timeout is None else Deadline(timeout)
+        user_json = self.__get_json(user_id_uri, None if deadline is None else deadline.split(2))
+        return self.__iter_composite_json(user_json, deadline, sections,
+                                          credit_card_state, device_state, given_url,
+                                          self.__excludes((credit_card_state, device_state)))
+
+    def iter_composite_users(self, user_ids, credit_card_state, device_state,
+                             given_url_for, max_concurrency=10, timeout=None):
+        '''
+        Runs composite_users for many users, at most max_concurrency at a time.
+        A failure for one user doesn't affect the others.
+
+        :param user_ids: unique identifiers of the users. Duplicates are
+                         only fetched once
+        :param credit_card_state: see composite_users
+        :param device_state: see composite_users
+        :param given_url_for: function returning the given_url (see
+                              composite_users) for a user ID
+        :param max_concurrency: maximum number of composite calls in flight
+        :param timeout: see composite_users. Applies to each user separately
+        :return: generator of (user_id, result, exception) tuples in
+                 completion order. Exactly one of result and exception is None
+        '''
+        user_ids = list(dict.fromkeys(user_ids))
+        if self.cache is not None and user_ids:
+            # Cached users are answered straight away, after a single trip to
+            # the cache for the whole batch
+            missing = []
+            cc_state, dev_state = normalize_state(credit_card_state), normalize_state(device_state)
+            for user_id, (documents, stale) in zip(user_ids, self.cache.lookup_many(user_ids)):
+                documents = User.restore(documents)
+                if documents is None or any(documents.section(section) is None for section in SECTIONS):
+                    missing.append(user_id)
+                    continue
+                if stale:
+                    self.__refresh(user_id, f'{self.base_url}/users/{user_id}')
+                yield user_id, composite(documents, SECTIONS, cc_state, dev_state,
+                                         given_url_for(user_id)), None
+            user_ids = missing
+
+        user_ids = iter(user_ids)
+        with ThreadPoolExecutor(max_workers=max_concurrency,
+                                thread_name_prefix='symplpay-batch') as executor:
+            # Only max_concurrency futures exist at any time, regardless of
+            # how many users were asked for
+            pending = {}
+            def submit_next():
+                for user_id in user_ids:
+                    future = executor.submit(self.composite_users, user_id,
+                                             credit_card_state, device_state,
+                                             given_url_for(user_id), timeout=timeout)
+                    pending[future] = user_id
+                    return
+
+            for _ in range(max_concurrency):
+                submit_next()
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    user_id = pending.pop(future)
+                    submit_next()
+                    try:
+                        yield user_id, future.result(), None
+                    except Exception as e:
+                        yield user_id, None, e
+
+    def invalidate(self, user_id=None):
+        '''
+        Drops cached REMOTE results.
+        :param user_id: unique identifier of the user to drop. Everything is
+                        flushed if None
+        :return: Nothing
+        '''
+        if self.cache is None:
+            return
+        if user_id is None:
+            self.cache.clear()
+        else:
+            self.cache.invalidate(user_id)
 
-        devices_url = user_json['_links']['devices']['href']
-        # Prior Comments on credit card pagination and states apply here as well.
-        devices_json = self.__get_json(devices_url)
-        devices = [ {'deviceId': x['deviceIdentifier'], 
-                     'state': x['state'],
-                     '_links': {'self': {'href': x['_links']['self']['href']}}} for x in devices_json['results']
-                     if device_state is None or x['state'].upper().strip()==device_state]
-        ret_val['devices'] = {
-            'totalResults': len(devices),
-            'results': devices
+    def stats(self):
+        '''
+        :return: dictionary of counters suitable for monitoring
+        '''
+        return {
+            'cache': None if self.cache is None else self.cache.stats(),
+            'singleFlight': None if self.flights is None else self.flights.stats(),
+            'retryBudget': None if self.retry_policy.budget is None else self.retry_policy.budget.stats(),
+            'circuitBreakers': None if self.breakers is None else self.breakers.stats(),
+            'hedging': None if self.hedge_policy is None else self.hedge_policy.stats(),
+            'etags': None if self.etags is None else self.etags.stats(),
+            'states': None if self.states is None else self.states.stats(),
+            'token': self.tokens.stats()
         }
 
-        return ret_val
+    def __get_cached_documents(self, user_id, user_id_uri, timeout, sections=SECTIONS, states=(None, None)):
+        '''
+        The cache holds unfiltered results, so a single entry serves every
+        combination of state filters for the user.
+        :param user_id: unique identifier of a user
+        :param user_id_uri: see composite_users
+        :param timeout: see composite_users
+        :param sections: sections needed
+        :param states: tuple of the normalized credit card and device states
+                       wanted. Only used to narrow down uncached results
+        :return: see __get_documents
+        '''
+        user_id_uri = f'{self.base_url}{user_id_uri % user_id}'
+        documents, stale = self.__lookup(user_id)
+        if documents is not None and any(documents.section(section) is None for section in sections):
+            # Cached for a request which skipped sections we need. Fetch them
+            # along with those already cached, so the entry stays consistent
+            sections = tuple(section for section in SECTIONS
+                             if section in sections or documents.section(section) is not None)
+            documents = None
+        if documents is None:
+            deadline = None if timeout is None else Deadline(timeout)
+            if self.cache is not None:
+                documents = self.__get_documents(user_id_uri, deadline, sections)
+                self.cache.set(user_id, documents)
+            else:
+                documents = self.__get_documents(user_id_uri, deadline, sections, self.__excludes(states))
+        elif stale:
+            self.__refresh(user_id, user_id_uri)
+        return documents
 
-    def __assign_token(self):
+    def __lookup(self, user_id):
         '''
-        A long-running server may need to refresh it's token.
+        :param user_id: unique identifier of a user
+        :return: tuple of the user's cached documents (see __get_documents)
+                 or None and whether they're stale
+        '''
+        if self.cache is None:
+            return None, False
+        documents, stale = self.cache.lookup(user_id)
+        return User.restore(documents), stale
+
+    def __encode(self, user_id, documents, sections, credit_card_state, device_state, given_url):
+        '''
+        :param user_id: unique identifier of a user
+        :param documents: see __get_documents
+        :param sections: sections to include
+        :return: see composite_users_json
+        '''
+        key = (user_id, credit_card_state, device_state, given_url, sections)
+        if self.encodings is not None:
+            entry = self.encodings.get(key)
+            if entry is not None and entry[0] is documents:
+                return entry[1], entry[2]
+
+        body = self.json_dumps(composite(documents, sections, credit_card_state, device_state, given_url))
+        etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        if self.encodings is not None:
+            self.encodings.set(key, (documents, body, etag))
+        return body, etag
+
+    def __iter_composite_json(self, user_json, deadline, sections,
+                              credit_card_state, device_state, given_url, excludes=None):
+        '''
+        See iter_composite_users_json. Each page is let go of once it's
+        written out.
+        :param user_json: /users/{userId} result
+        :param deadline: optional Deadline every page must meet
+        :param sections: sections to include
+        :param excludes: see __excludes
+        :return: generator of JSON encoded bytes
+        '''
+        excludes = excludes or {}
+        states = {'creditCards': credit_card_state, 'devices': device_state}
+
+        # Encode the result with placeholders in place of each section's
+        # results and count, leaving the bytes in between to be written out
+        # as they are. Byte for byte the same as composite_users_json then,
+        # whatever json_dumps' separators are
+        placeholder = '\0'
+        skeleton = {'_links': {'self': {'href': given_url}}, 'userId': user_json['id']}
+        for section in sections:
+            skeleton[section] = {'results': [placeholder], 'totalResults': placeholder}
+        pieces = self.json_dumps(skeleton).split(self.json_dumps(placeholder))
+        separator = self.json_dumps([0, 0])[1:-1].strip(b'0')
+
+        yield pieces[0]
+        for i, (section, url) in enumerate(zip(sections, linked_urls(user_json, sections))):
+            total = 0
+            for page in self.__iter_pages(excluding(url, excludes.get(section)), deadline):
+                if self.states is not None and not excludes.get(section):
+                    self.states.observe(section, url, page)
+                results = section_results(records_of(section, page), states[section])
+                if results:
+                    # The list's items without its brackets
+                    yield (separator if total else b'') + self.json_dumps(results)[1:-1]
+                    total += len(results)
+            yield pieces[2 * i + 1] + str(total).encode() + pieces[2 * i + 2]
+
+    def __refresh(self, user_id, user_id_uri):
+        '''
+        Re-fetches a stale cache entry in the background. If the REMOTE calls
+        fail (i.e., __get_json gives up retrying), the stale entry is left
+        in place to be served until its grace window runs out.
+        :param user_id: unique identifier of a user
+        :param user_id_uri: full URL of the user
+        :return: Nothing
+        '''
+        if self.refresher is None:
+            # Only caches with a grace window are meant to hand back stale
+            # entries, but better to serve it as-is than to fail
+            return
+        with self.refreshing_lock:
+            if user_id in self.refreshing:
+                return
+            self.refreshing.add(user_id)
+
+        def refresh():
+            try:
+                self.cache.set(user_id, self.__get_documents(user_id_uri))
+            except Exception as e:
+                self.l.error(f'Failed to refresh {user_id}, serving stale results: {e}')
+            finally:
+                with self.refreshing_lock:
+                    self.refreshing.discard(user_id)
+
+        self.refresher.submit(refresh)
+
+    def __get_documents(self, user_id_uri, deadline=None, sections=SECTIONS, excludes=None):
+        '''
+        Issues the REMOTE calls.
+        :param user_id_uri: full URL of the user
+        :param deadline: optional Deadline all calls must meet
+        :param sections: sections to fetch along with the user
+        :param excludes: see __excludes. None leaves every state in
+        :return: records.User holding the REMOTE results, unfiltered unless
+                 excludes says otherwise. Sections not fetched are None
+        '''
+        self.l.debug(f'User ID URL is {user_id_uri}')
+        excludes = excludes or {}
+
+        if self.speculative:
+            user_json, *sections_json = self.__get_speculative_json(user_id_uri, deadline, sections, excludes)
+        else:
+            # Leave the user call half of the time so the calls depending
+            # upon it aren't starved
+            user_json = self.__get_json(user_id_uri, None if deadline is None else deadline.split(2))
+            # The credit card and device calls only depend upon the user's
+            # "_links", so they're free to run concurrently (see max_in_flight)
+            urls = [excluding(url, excludes.get(section))
+                    for section, url in zip(sections, linked_urls(user_json, sections))]
+            sections_json = self.__get_all_json(urls, deadline, pull=self.__get_collection)
+
+        if self.states is not None:
+            for section, url, section_json in zip(sections, linked_urls(user_json, sections), sections_json):
+                if not excludes.get(section):
+                    self.states.observe(section, url, section_json)
+
+        sections_json = dict(zip(sections, sections_json))
+        return User.from_json(user_json, sections_json.get('creditCards'), sections_json.get('devices'))
+
+    def __excludes(self, states):
+        '''
+        :param states: tuple of the normalized credit card and device states
+                       wanted
+        :return: dictionary of section to the states the REMOTE server may
+                 leave out of it or None if it mustn't leave any out
+        '''
+        if self.states is None:
+            return None
+        return {section: self.states.exclude(section, state) for section, state in zip(SECTIONS, states)}
+
+    def __fetch_token(self):
+        '''
+        A long-running server may need to refresh it's token. Always called
+        by self.tokens, which makes sure only one fetch runs at a time.
         '''
-        self.client = BackendApplicationClient(client_id=self.client_id)
-        self.session = OAuth2Session(client=self.client)
         self.l.debug('Fetching new token.')
-        self.token = self.session.fetch_token(token_url=self.token_url,
+        return self.token_session.fetch_token(token_url=self.token_url,
                                               client_id=self.client_id,
                                               client_secret=self.client_secret)
-        return self.token
 
-    def __get_json(self, url):
+    def __new_sessions(self):
+        '''
+        Sets up the session API calls are made over (and its connection
+        pool) along with the one tokens are fetched over.
+        '''
+        self.session = OAuth2Session(client=self.client)
+        adapter = PoolingAdapter(**self.pool_args)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Tokens are fetched over a session of their own so request threads
+        # never see self.session half-way through a fetch
+        self.token_session = OAuth2Session(client=BackendApplicationClient(client_id=self.client_id))
+
+    def __after_fork(self):
+        '''
+        Drops connections inherited from the parent process. Their locks may
+        have been held by parent threads which didn't survive the fork, so
+        the sessions are replaced rather than closed.
+        '''
+        self.__new_sessions()
+        if self.token is not None:
+            self.session.token = self.token
+
+    def __install_token(self, token):
+        '''
+        Makes token the one sent with all further requests.
+        '''
+        self.token = token
+        self.session.token = token
+
+    def __iter_pages(self, url, deadline=None):
+        '''
+        Reads a REMOTE collection one page at a time.
+        :param url: URL of the collection
+        :param deadline: optional Deadline every page must meet
+        :return: generator of JSON pages
+        '''
+        if self.page_size is not None:
+            url = with_query(url, limit=self.page_size)
+        seen = set()
+        while url is not None and url not in seen:
+            if len(seen) == MAX_PAGES:
+                self.l.error(f'Gave up on {url} after {MAX_PAGES} pages!')
+                return
+            seen.add(url)
+            page = self.__get_json(url, deadline, self.parse_collection)
+            yield page
+            url = next_page_url(url, page)
+
+    def __get_collection(self, url, deadline=None):
+        '''
+        Reads every page of a REMOTE collection.
+        :param url: URL of the collection
+        :param deadline: optional Deadline every page must meet
+        :return: JSON result shaped like a single page holding every result
+        '''
+        return merge_pages(list(self.__iter_pages(url, deadline)))
+
+    def __get_json(self, url, deadline=None, parse=None):
+        '''
+        Given a URL, pulls a JSON result from it. Concurrent callers asking for
+        the same URL share a single upstream call unless coalescing is off.
+        :param deadline: optional Deadline the call must meet
+        :param parse: see __pull_json
+        '''
+        if self.flights is None:
+            return self.__pull_json(url, deadline, parse)
+        try:
+            # Whoever does the work does it under their own deadline, which
+            # is no reason for the others to give up before theirs
+            return self.flights.do(url, self.__pull_json, url, deadline, parse,
+                                   timeout=None if deadline is None else deadline.remaining(),
+                                   private_errors=(DeadlineExceeded,))
+        except TimeoutError:
+            raise DeadlineExceeded(url)
+
+    def __pull_json(self, url, deadline=None, parse=None):
         '''
         Given a URL, tries to pull a JSON result from it in a fault-tolerant manner.
-        I.e., repeats the request up to a maximum number of retries, sleeping
-        between attempts as to not cause a DoS. 
+        I.e., repeats the request for as long as the retry policy (and the
+        deadline) allows, backing off between attempts as to not cause a DoS. 
+        :param parse: optional function turning a streamed requests.Response
+                      into its JSON result as it's read. None reads the
+                      response whole first
         '''
+        policy = self.retry_policy
+        policy.record_request()
         last_status_code = None
+        err_msg = f'Retry attempts exhausted for {url}!'
+        # Revalidate what the REMOTE server told us last time, if it gave an ETag
+        validated = None if self.etags is None else self.etags.get(url)
+        headers = None if validated is None else {'If-None-Match': validated[0]}
 
-        for i in range(self.max_retries):
+        for attempt in range(policy.max_attempts):
+            retry_after = None
+            token = self.tokens.current()
+            if deadline is not None:
+                deadline.check(url)
             try:
-                response = self.session.get(url)
-                if response.ok:
-                    return response.json()
-                else:
-                    num_retries = self.max_retries - i - 1
-                    last_status_code = response.status_code
-                    if num_retries:
-                        self.l.error(f'Bad response ({response.status_code}) from {url}! Retryring {num_retries} more times.')
-                        sleep(self.retry_sleep)
+                # Closing hands the connection back to the pool even if a
+                # streamed response isn't read through
+                with self.__send(url, None if deadline is None else deadline.remaining(), headers,
+                                 stream=parse is not None) as response:
+                    if response.status_code == 304 and validated is not None:
+                        return validated[1]
+                    if response.ok:
+                        json_result = response.json() if parse is None else parse(response)
+                        etag = response.headers.get('ETag')
+                        if self.etags is not None and etag is not None:
+                            self.etags.set(url, (etag, json_result))
+                        return json_result
+                last_status_code = response.status_code
+                self.l.error(f'Bad response ({response.status_code}) from {url}!')
+                if not policy.retries_status(response.status_code):
+                    err_msg = f'Bad response ({response.status_code}) from {url}!'
+                    break
+                retry_after = response.headers.get('Retry-After')
             except TokenExpiredError as e:
-                num_retries = self.max_retries - i - 1
+                # Nothing reached the remote server, so there's no need to
+                # back off
                 last_status_code = 401
                 self.l.error(f'Token expired! Renewing...')
-                self.__assign_token()
+                self.tokens.refresh(token)
+                continue
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                # Streamed responses may also be cut short while being read
+                last_status_code = 504 if isinstance(e, requests.exceptions.Timeout) else 502
+                self.l.error(f'Failed to reach {url}: {e}')
+                if deadline is not None:
+                    deadline.check(url)
+                if not policy.retry_connection_errors:
+                    break
+
+            delay = policy.retry_delay(attempt, retry_after)
+            if delay is None:
+                break
+            if deadline is not None and delay >= deadline.remaining():
+                self.l.error(f'Not enough time left to retry {url}.')
+                raise DeadlineExceeded(url)
+            self.l.error(f'Retrying {url} in {delay:.2f} seconds.')
+            sleep(delay)
+
+        self.l.error(err_msg)
+        error = urllib.error.HTTPError(url, last_status_code, err_msg, None, None)
+        raise error
+
+    def __send(self, url, timeout=None, headers=None, stream=False):
+        '''
+        Issues a GET. If hedging is on and the GET takes longer than usual, a
+        duplicate is sent which stands in for the GET should it fail.
+        :param url: URL to GET
+        :param timeout: time in seconds to wait on the connection and on each
+                        read from it. None waits forever
+        :param headers: optional dictionary of extra request headers
+        :param stream: return once the headers are in, leaving the body to be
+                       read from the response
+        :return: requests.Response
+        '''
+        if self.hedge_policy is None:
+            return self.__send_once(url, timeout, headers, stream)
+
+        delay = self.hedge_policy.delay(url)
+        if delay is None:
+            return self.__send_once(url, timeout, headers, stream)
+
+        # The primary GET stays on the calling thread so the bounded hedger
+        # pool only ever holds hedges. Those are cancelled if still queued
+        # when the primary answers
+        primary_done = threading.Event()
+        hedge = self.hedger.submit(self.__hedge, primary_done, monotonic() + delay,
+                                   url, timeout, headers, stream)
+        try:
+            response = self.__send_once(url, timeout, headers, stream)
+        except Exception:
+            primary_done.set()
+            # A failed GET only counts if the hedge failed (or wasn't sent) too
+            if hedge.cancel() or hedge.exception() is not None or hedge.result() is None:
+                raise
+            self.hedge_policy.record_win()
+            return hedge.result()
+        primary_done.set()
+        if stream and not hedge.cancel():
+            # Nobody reads the hedge's body, so give its connection back
+            hedge.add_done_callback(lambda f: f.exception() is None and f.result() is not None
+                                    and f.result().close())
+        return response
+
+    def __hedge(self, primary_done, hedge_at, url, timeout=None, headers=None, stream=False):
+        '''
+        Sends a hedge for a GET unless its primary answers first.
+        :param primary_done: threading.Event set once the primary has answered
+        :param hedge_at: monotonic time at which to send the hedge
+        :param url: see __send
+        :param timeout: see __send
+        :param headers: see __send
+        :param stream: see __send
+        :return: requests.Response or None if no hedge was sent
+        '''
+        if primary_done.wait(max(0, hedge_at - monotonic())) or not self.hedge_policy.try_hedge():
+            return None
+        self.l.debug(f'Hedging {url}.')
+        return self.__send_once(url, timeout, headers, stream)
+
+    def __send_once(self, url, timeout=None, headers=None, stream=False):
+        '''
+        Issues a single GET, keeping the endpoint's circuit breaker (and
+        hedging latencies) informed. Only 5xx responses, connection errors
+        and timeouts count as failures.
+        :param url: URL to GET
+        :param timeout: see __send
+        :param headers: see __send
+        :param stream: see __send
+        :return: requests.Response
+        :raises CircuitOpenError: if the endpoint's circuit breaker is open
+        '''
+        if self.breakers is None:
+            start = monotonic()
+            response = self.session.get(url, timeout=timeout, headers=headers, stream=stream)
+            if self.hedge_policy is not None:
+                self.hedge_policy.record_latency(url, monotonic() - start)
+            return response
+
+        breaker = self.breakers.for_url(url)
+        if not breaker.allow():
+            raise CircuitOpenError(url, breaker.name)
+        start = monotonic()
+        try:
+            response = self.session.get(url, timeout=timeout, headers=headers, stream=stream)
+        except TokenExpiredError:
+            breaker.abandon()
+            raise
+        except Exception:
+            breaker.record(False, monotonic() - start)
+            raise
+        breaker.record(response.status_code < 500, monotonic() - start)
+        if self.hedge_policy is not None:
+            self.hedge_policy.record_latency(url, monotonic() - start)
+        return response
+
+    def __get_all_json(self, urls, deadline=None, return_exceptions=False, pull=None):
+        '''
+        Pulls JSON results from several URLs, keeping at most max_in_flight
+        of them outstanding at any given time.
+        :param urls: list of URLs
+        :param deadline: optional Deadline all calls must meet. Calls which
+                         haven't started by then are cancelled
+        :param return_exceptions: hand back the exception raised for a URL in
+                                  place of its result instead of raising it
+        :param pull: function taking a URL and deadline and returning its
+                     JSON result. Defaults to __get_json
+        :return: list of JSON results in the same order as urls
+        '''
+        pull = pull or self.__get_json
+        def get_json(url):
+            try:
+                return pull(url, deadline)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return e
+
+        if self.executor is None or len(urls) <= 1:
+            return [get_json(url) for url in urls]
+
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        def get_json_released(url):
+            try:
+                return get_json(url)
+            finally:
+                in_flight.release()
+
+        futures = []
+        for url in urls:
+            if not in_flight.acquire(timeout=None if deadline is None else deadline.remaining()):
+                break
+            futures.append(self.executor.submit(get_json_released, url))
+
+        if deadline is not None:
+            _, not_done = wait(futures, timeout=deadline.remaining())
+            if not_done or len(futures) < len(urls):
+                for f in not_done:
+                    f.cancel()
+                late_urls = [url for url, f in zip(urls, futures) if f in not_done] + urls[len(futures):]
+                raise DeadlineExceeded(late_urls[0])
+        return [f.result() for f in futures]
+
+    def __get_speculative_json(self, user_id_uri, deadline=None, sections=SECTIONS, excludes=None):
+        '''
+        Fetches the user, credit card and device results at the same time by
+        guessing the latter two URLs instead of reading them from the user's
+        "_links". A guess is only re-fetched if it turns out to be wrong
+        (or failed).
+        :param user_id_uri: full URL of the user
+        :param deadline: optional Deadline all calls must meet
+        :param sections: sections to fetch along with the user
+        :param excludes: see __excludes
+        :return: tuple of the user's JSON result followed by each section's
+        '''
+        excludes = excludes or {}
+        guessed_urls = [excluding(f'{user_id_uri}/{section}', excludes.get(section)) for section in sections]
+        def pull(url, deadline):
+            return self.__get_json(url, deadline) if url == user_id_uri else self.__get_collection(url, deadline)
+        user_json, *guessed_json = self.__get_all_json([user_id_uri] + guessed_urls, deadline,
+                                                       return_exceptions=True, pull=pull)
+        if isinstance(user_json, Exception):
+            raise user_json
+
+        actual_urls = [excluding(url, excludes.get(section))
+                       for section, url in zip(sections, linked_urls(user_json, sections))]
+        misses = [i for i, (guessed_url, actual_url) in enumerate(zip(guessed_urls, actual_urls))
+                  if guessed_url != actual_url or isinstance(guessed_json[i], Exception)]
+        if misses:
+            self.l.debug(f'Speculation missed for {[actual_urls[i] for i in misses]}. Re-fetching.')
+            for i, result in zip(misses, self.__get_all_json([actual_urls[i] for i in misses], deadline,
+                                                             pull=self.__get_collection)):
+                guessed_json[i] = result
+
+        return (user_json, *guessed_json)
+
+
+# -----------------------------------------------------------------------------
+class AsyncClient(object):
+    '''
+    asyncio flavor of Client.
+    Issues outgoing HTTP requests over a pooled aiohttp session, merging
+    results into a single JSON result. Many composite calls may be in flight
+    at once without tying up a thread apiece.
+    '''
+    def __init__(self,
+                 client_id, client_secret, base_url, token_url,
+                 l,
+                 max_retries=3, retry_sleep=1, pool_size=100, retry_policy=None, page_size=None):
+        '''
+        Constructor
+        :param client_id: REST API username for base_url
+        :param client_secret: REST API password for base_url
+        :param base_url: base URL of the REST services we'll consume
+        :param token_url: URL used for token generator
+        :param l: Python logger
+        :param max_retries: if we timeout or otherwise fail to invoke an API,
+                            this is the maximum number of retry attempts we'll
+                            make
+        :param retry_sleep: time in seconds we sleep before the first retry
+        :param pool_size: maximum number of pooled connections to base_url
+        :param retry_policy: see Client
+        :param page_size: see Client
+        :return: Instance of this class.
+        '''
+        if aiohttp is None:
+            raise ImportError('AsyncClient requires the "aiohttp" package. Please run "pip install aiohttp".')
+
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.base_url = base_url
+        self.token_url = token_url
+        self.l = l
+
+        self.max_retries = max_retries
+        self.retry_sleep = retry_sleep
+        self.retry_policy = retry_policy
+        if self.retry_policy is None:
+            self.retry_policy = RetryPolicy(max_attempts=max_retries, base_sleep=retry_sleep)
+        self.pool_size = pool_size
+        self.page_size = page_size
+
+        self.client = BackendApplicationClient(client_id=self.client_id)
+        self.token = None
+        # aiohttp sessions and locks belong to an event loop, so both are
+        # created on first use from within the loop
+        self.session = None
+        self.token_lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        '''
+        Closes the pooled connections.
+        :return: Nothing
+        '''
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def composite_users(self, user_id, credit_card_state, device_state,
+                              given_url, user_id_uri='/users/%s'):
+        '''
+        See Client.composite_users. The credit card and device calls are
+        issued concurrently once the user result arrives.
+        '''
+        # Normalize parameters
+        credit_card_state = normalize_state(credit_card_state)
+        device_state = normalize_state(device_state)
+
+        user_id_uri = f'{self.base_url}{user_id_uri % user_id}'
+        self.l.debug(f'User ID URL is {user_id_uri}')
+
+        user_json = await self.__get_json(user_id_uri)
+        credit_cards_json, devices_json = await asyncio.gather(
+            *[self.__get_collection(url) for url in linked_urls(user_json)])
+
+        return composite(User.from_json(user_json, credit_cards_json, devices_json),
+                         SECTIONS, credit_card_state, device_state, given_url)
+
+    async def __get_collection(self, url):
+        '''
+        Reads every page of a REMOTE collection. See Client.__iter_pages.
+        :param url: URL of the collection
+        :return: see merge_pages
+        '''
+        if self.page_size is not None:
+            url = with_query(url, limit=self.page_size)
+        pages = []
+        seen = set()
+        while url is not None and url not in seen:
+            if len(seen) == MAX_PAGES:
+                self.l.error(f'Gave up on {url} after {MAX_PAGES} pages!')
+                break
+            seen.add(url)
+            pages.append(await self.__get_json(url))
+            url = next_page_url(url, pages[-1])
+        return merge_pages(pages)
+
+    async def __assign_token(self, stale_token=None):
+        '''
+        Fetches a new token unless another task already replaced stale_token
+        while we waited on the lock.
+        :param stale_token: the token which was found to be expired
+        :return: current token
+        '''
+        if self.token_lock is None:
+            self.token_lock = asyncio.Lock()
+
+        async with self.token_lock:
+            if self.token is not stale_token:
+                return self.token
+
+            self.l.debug('Fetching new token.')
+            body = self.client.prepare_request_body()
+            async with self.session.post(self.token_url, data=body,
+                                         auth=aiohttp.BasicAuth(self.client_id, self.client_secret),
+                                         headers={'Accept': 'application/json',
+                                                  'Content-Type': 'application/x-www-form-urlencoded'}) as response:
+                text = await response.text()
+            self.token = self.client.parse_request_body_response(text)
+            return self.token
+
+    async def __get_json(self, url):
+        '''
+        Given a URL, tries to pull a JSON result from it in a fault-tolerant manner.
+        See Client.__get_json.
+        '''
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size))
+        if self.token is None:
+            await self.__assign_token()
+
+        policy = self.retry_policy
+        policy.record_request()
+        last_status_code = None
+        err_msg = f'Retry attempts exhausted for {url}!'
+
+        for attempt in range(policy.max_attempts):
+            retry_after = None
+            token = self.token
+            try:
+                uri, headers, _ = self.client.add_token(url, http_method='GET')
+                async with self.session.get(uri, headers=headers) as response:
+                    if response.status < 400:
+                        return await response.json()
+                    last_status_code = response.status
+                    retry_after = response.headers.get('Retry-After')
+                self.l.error(f'Bad response ({last_status_code}) from {url}!')
+                if not policy.retries_status(last_status_code):
+                    err_msg = f'Bad response ({last_status_code}) from {url}!'
+                    break
+            except TokenExpiredError as e:
+                last_status_code = 401
+                self.l.error(f'Token expired! Renewing...')
+                await self.__assign_token(token)
+                continue
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                last_status_code = 504 if isinstance(e, asyncio.TimeoutError) else 502
+                self.l.error(f'Failed to reach {url}: {e}')
+                if not policy.retry_connection_errors:
+                    break
+
+            delay = policy.retry_delay(attempt, retry_after)
+            if delay is None:
+                break
+            self.l.error(f'Retrying {url} in {delay:.2f} seconds.')
+            await asyncio.sleep(delay)
 
-            if not num_retries:
-                err_msg = f'Retry attempts exhausted for {url}!'
-                self.l.error(err_msg)
-                error = urllib.error.HTTPError(url, last_status_code, err_msg, None, None)
-                raise error
+        self.l.error(err_msg)
+        error = urllib.error.HTTPError(url, last_status_code, err_msg, None, None)
+        raise error
 
 
 # --MAIN----------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,86 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+from time import monotonic
+from urllib.error import HTTPError
+
+# -----------------------------------------------------------------------------
+class DeadlineExceeded(HTTPError):
+    '''
+    Raised once a request's deadline has run out.
+    Surfaces as a 504 to our own callers.
+    '''
+    def __init__(self, url):
+        '''
+        Constructor
+        :param url: URL being worked on when time ran out
+        :return: Instance of this class.
+        '''
+        super().__init__(url, 504, f'Deadline exceeded while fetching {url}!', None, None)
+
+# -----------------------------------------------------------------------------
+class Deadline(object):
+    '''
+    Point in time by which a request, including all of its upstream calls
+    and their retries, must be done.
+    '''
+    def __init__(self, timeout, clock=monotonic):
+        '''
+        Constructor
+        :param timeout: time in seconds from now
+        :param clock: function returning the current time in seconds
+        :return: Instance of this class.
+        '''
+        self.clock = clock
+        self.expires_at = clock() + timeout
+
+    def remaining(self):
+        '''
+        :return: time in seconds left, never negative
+        '''
+        return max(0.0, self.expires_at - self.clock())
+
+    def expired(self):
+        '''
+        :return: True if no time is left
+        '''
+        return self.remaining() <= 0
+
+    def split(self, parts):
+        '''
+        Used to share the time left between sequential stages of a request.
+        :param parts: number of stages left, this one included
+        :return: Deadline for the current stage, i.e. a 1/parts share of the
+                 time left
+        '''
+        return Deadline(self.remaining() / parts, self.clock)
+
+    def check(self, url):
+        '''
+        :param url: URL being worked on
+        :return: Nothing
+        :raises DeadlineExceeded: if no time is left
+        '''
+        if self.expired():
+            raise DeadlineExceeded(url)
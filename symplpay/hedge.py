@@ -0,0 +1,133 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+import threading
+from collections import deque
+
+from symplpay.retry import RetryBudget
+from symplpay.breaker import endpoint
+
+# -----------------------------------------------------------------------------
+class HedgePolicy(object):
+    '''
+    Decides when a duplicate ("hedged") GET is sent for an upstream call
+    which is taking unusually long: once it has been outstanding for longer
+    than the given percentile of recent latencies to the same endpoint.
+    Hedges are drawn from a budget so they can't amplify load during an
+    outage.
+    '''
+    def __init__(self, percentile=95, min_delay=0.01, samples=1000, min_samples=20,
+                 budget=None):
+        '''
+        Constructor
+        :param percentile: percentile of recent latencies after which a GET
+                           is hedged
+        :param min_delay: lower bound in seconds on the hedging delay
+        :param samples: number of recent latencies remembered per endpoint
+        :param min_samples: latencies needed before an endpoint is hedged
+        :param budget: symplpay.retry.RetryBudget limiting hedges to a
+                       fraction of primary GETs. Defaults to 5%
+        :return: Instance of this class.
+        '''
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.samples = samples
+        self.min_samples = min_samples
+        self.budget = budget if budget is not None else RetryBudget(ratio=0.05, min_per_second=0)
+
+        # endpoint -> [recent latencies, cached delay or None, latencies
+        # recorded since the delay was last worked out]
+        self.latencies = {}
+        self.lock = threading.Lock()
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def record_latency(self, url, latency):
+        '''
+        :param url: REMOTE URL which answered
+        :param latency: time in seconds it took
+        :return: Nothing
+        '''
+        with self.lock:
+            entry = self.latencies.setdefault(endpoint(url), [deque(maxlen=self.samples), None, 0])
+            entry[0].append(latency)
+            entry[2] += 1
+            # Re-sorting on every answer is wasteful; the percentile barely
+            # moves between a handful of samples. The deque's length stops
+            # growing once it is full, hence the separate count
+            if entry[1] is None or entry[2] >= 50:
+                entry[1] = self.__delay(entry[0])
+                entry[2] = 0
+
+    def delay(self, url):
+        '''
+        Records a primary GET against the budget.
+        :param url: REMOTE URL about to be called
+        :return: time in seconds after which to hedge or None if the
+                 endpoint hasn't been sampled enough yet
+        '''
+        self.budget.record_request()
+        entry = self.latencies.get(endpoint(url))
+        return None if entry is None else entry[1]
+
+    def try_hedge(self):
+        '''
+        :return: True if the budget allows for one more hedge
+        '''
+        if not self.budget.try_spend():
+            return False
+        with self.lock:
+            self.hedged += 1
+        return True
+
+    def record_win(self):
+        '''
+        Records a hedge standing in for a primary GET which failed.
+        :return: Nothing
+        '''
+        with self.lock:
+            self.hedge_wins += 1
+
+    def stats(self):
+        '''
+        :return: dictionary of counters suitable for monitoring
+        '''
+        with self.lock:
+            return {
+                'hedged': self.hedged,
+                'hedgeWins': self.hedge_wins,
+                'delays': {name: entry[1] for name, entry in self.latencies.items()},
+                'budget': self.budget.stats()
+            }
+
+    def __delay(self, latencies):
+        '''
+        :param latencies: recent latencies of an endpoint
+        :return: hedging delay or None if there aren't enough latencies
+        '''
+        if len(latencies) < self.min_samples:
+            return None
+        latencies = sorted(latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return max(self.min_delay, latencies[index])
@@ -0,0 +1,127 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# --GLOBALS--------------------------------------------------------------------
+# Bytes read off the REMOTE server at a time
+CHUNK_SIZE = 64 * 1024
+
+# ijson prefix of a field within each result -> its key
+RESULT_FIELDS = {
+    'results.item.creditCardId': 'creditCardId',
+    'results.item.deviceIdentifier': 'deviceIdentifier',
+    'results.item.state': 'state',
+}
+RESULT_HREF = 'results.item._links.self.href'
+# Paging fields of the collection itself (see client.next_page_url)
+PAGE_FIELDS = {'totalResults', 'offset', 'limit'}
+NEXT_HREF = '_links.next.href'
+
+# --HELPER FUNCTIONS ----------------------------------------------------------
+def check_available():
+    '''
+    :return: Nothing
+    :raises ImportError: if the ijson package is unavailable
+    '''
+    if ijson is None:
+        raise ImportError('The "ijson" package is unavailable. Please run "pip install ijson".')
+
+def parse_collection(chunks):
+    '''
+    Parses a page of a REMOTE collection (/users/{userId}/creditCards or
+    /users/{userId}/devices) as it's read, keeping only what the composite
+    result and paging need. Everything else is skipped over without ever
+    being turned into Python objects.
+    :param chunks: iterable of the page's JSON bytes
+    :return: JSON page shaped like the REMOTE one, with each result holding
+             nothing but its "creditCardId" or "deviceIdentifier", "state"
+             and "_links.self.href"
+    :raises ValueError: on malformed JSON
+    '''
+    check_available()
+    results = []
+    page = {'results': results}
+    result = None
+    try:
+        # Most events belong to fields nobody wants, so they're told apart
+        # from the rest with as few comparisons as possible
+        for prefix, event, value in ijson.parse(ChunkReader(chunks), use_float=True):
+            if event == 'string':
+                key = RESULT_FIELDS.get(prefix)
+                if key is not None:
+                    result[key] = value
+                elif prefix == RESULT_HREF:
+                    result['_links'] = {'self': {'href': value}}
+                elif prefix == NEXT_HREF:
+                    page['_links'] = {'next': {'href': value}}
+            elif event == 'number':
+                if prefix in PAGE_FIELDS:
+                    page[prefix] = value
+            elif prefix == 'results.item':
+                if event == 'start_map':
+                    result = {}
+                elif event == 'end_map':
+                    results.append(result)
+    except ijson.JSONError as e:
+        raise ValueError(f'Malformed JSON: {e}')
+    return page
+
+def parse_response(response):
+    '''
+    :param response: streamed requests.Response of a page of a REMOTE
+                     collection
+    :return: see parse_collection
+    '''
+    return parse_collection(response.iter_content(CHUNK_SIZE))
+
+# -----------------------------------------------------------------------------
+class ChunkReader(object):
+    '''
+    File-like view of an iterable of bytes, as ijson reads from files.
+    '''
+    def __init__(self, chunks):
+        '''
+        Constructor
+        :param chunks: iterable of bytes
+        :return: Instance of this class.
+        '''
+        self.chunks = iter(chunks)
+
+    def read(self, size=-1):
+        '''
+        :param size: ignored, except that 0 reads nothing (which ijson does
+                     to tell bytes from text). Chunks are handed over as
+                     they come
+        :return: next non-empty chunk or b'' once there are no more
+        '''
+        if size == 0:
+            return b''
+        for chunk in self.chunks:
+            if chunk:
+                return chunk
+        return b''
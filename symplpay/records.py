@@ -0,0 +1,172 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+import sys
+from collections import namedtuple
+
+# -----------------------------------------------------------------------------
+class CreditCard(namedtuple('CreditCard', ('id', 'state', 'href'))):
+    '''
+    What composite results keep of a /users/{userId}/creditCards result.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_json(cls, x):
+        '''
+        :param x: a single credit card pulled from the remote server
+        :return: Instance of this class.
+        '''
+        # States repeat endlessly, so every record shares the same copy
+        return cls(x['creditCardId'], sys.intern(x['state']), x['_links']['self']['href'])
+
+    def to_json(self):
+        '''
+        :return: the credit card as it appears in composite results
+        '''
+        return {'creditCardId': self.id, 'state': self.state, '_links': {'self': {'href': self.href}}}
+
+# -----------------------------------------------------------------------------
+class Device(namedtuple('Device', ('id', 'state', 'href'))):
+    '''
+    What composite results keep of a /users/{userId}/devices result.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_json(cls, x):
+        '''
+        :param x: a single device pulled from the remote server
+        :return: Instance of this class.
+        '''
+        return cls(x['deviceIdentifier'], sys.intern(x['state']), x['_links']['self']['href'])
+
+    def to_json(self):
+        '''
+        :return: the device as it appears in composite results
+        '''
+        return {'deviceId': self.id, 'state': self.state, '_links': {'self': {'href': self.href}}}
+
+# -----------------------------------------------------------------------------
+class User(namedtuple('User', ('id', 'credit_cards', 'devices'))):
+    '''
+    Unfiltered REMOTE results of a user, as kept in the cache. credit_cards
+    and devices are tuples of CreditCard and Device, or None if they
+    weren't fetched.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_json(cls, user_json, credit_cards_json=None, devices_json=None):
+        '''
+        :param user_json: /users/{userId} result
+        :param credit_cards_json: /users/{userId}/creditCards result or None
+        :param devices_json: /users/{userId}/devices result or None
+        :return: Instance of this class.
+        '''
+        return cls(user_json['id'],
+                   None if credit_cards_json is None else records_of('creditCards', credit_cards_json),
+                   None if devices_json is None else records_of('devices', devices_json))
+
+    @classmethod
+    def restore(cls, value):
+        '''
+        Caches living elsewhere (e.g., rediscache.RedisCache) hand back
+        records as plain JSON lists.
+        :param value: cached value
+        :return: value as an instance of this class or None if it isn't one
+                 (e.g., it was cached by an older version)
+        '''
+        if value is None or isinstance(value, cls):
+            return value
+        if not isinstance(value, (list, tuple)) or len(value) != len(cls._fields):
+            return None
+        user_id, credit_cards, devices = value
+        return cls(user_id,
+                   None if credit_cards is None else tuple(CreditCard._make(x) for x in credit_cards),
+                   None if devices is None else tuple(Device._make(x) for x in devices))
+
+    def section(self, name):
+        '''
+        :param name: "creditCards" or "devices"
+        :return: records of that section or None if it wasn't fetched
+        '''
+        return self.credit_cards if name == 'creditCards' else self.devices
+
+# --HELPER FUNCTIONS ----------------------------------------------------------
+def records_of(section, collection_json):
+    '''
+    :param section: "creditCards" or "devices"
+    :param collection_json: /users/{userId}/creditCards or
+                            /users/{userId}/devices result, or a single page
+                            of one
+    :return: tuple of CreditCard or Device
+    '''
+    record = CreditCard if section == 'creditCards' else Device
+    return tuple(record.from_json(x) for x in collection_json['results'])
+
+def section_results(records, state):
+    '''
+    :param records: CreditCard or Device records
+    :param state: normalized state to filter on. Ignored if None
+    :return: list of the records matching state, as they appear in
+             composite results
+    '''
+    # Although /users/{userId}/creditCards does provide an "excludeState"
+    # param, it doesn't include an "includeState". Translation: to perform the
+    # filter server-side one would need to either maintain a hard-coded list
+    # here of all credit card states (BAD IDEA - states can be added/renamed 
+    # over time) *or* invoke a REST API method to obtain this info (BAD IDEA -
+    # to be on the safe side, you'd need to invoke it every time this function is
+    # called and it's not worth it when there are small numbers of credit 
+    # cards associated with each user).  Instead, I simply use a Python list
+    # comprehension on the records pulled from the remote server to filter them
+    # out. The Client can narrow things down server-side with the states it has
+    # seen so far (see Client.exclude_states), but this filter stays regardless
+    # in case a state it hasn't seen yet shows up. The same goes for devices.
+    return [x.to_json() for x in records if state is None or x.state.upper().strip() == state]
+
+def composite(user, sections, credit_card_state, device_state, given_url):
+    '''
+    Builds the composite result of a user in the shape documented by
+    client.Client.composite_users, ready to be encoded in one go.
+    :param user: User
+    :param sections: sections to include
+    :param credit_card_state: normalized credit card state filter or None
+    :param device_state: normalized device state filter or None
+    :param given_url: URL used to invoke our own REST API
+    :return: composite dictionary
+    '''
+    # In theory, we could just take the user ID we were asked for... Could
+    # also be the case the API normalized the user ID somehow though;)
+    ret_val = {'_links': {'self': {'href': given_url}}, 'userId': user.id}
+    states = {'creditCards': credit_card_state, 'devices': device_state}
+    for section in sections:
+        results = section_results(user.section(section), states[section])
+        # Intentionally do not include "offset" and "limit" as every REMOTE
+        # page has been read by now and this REST API does not paginate.
+        # "totalResults" comes last so that streamed results (see
+        # Client.iter_composite_users_json) can count as they go.
+        ret_val[section] = {'results': results, 'totalResults': len(results)}
+    return ret_val
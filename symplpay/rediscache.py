@@ -0,0 +1,181 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+import json
+import threading
+import time
+
+from symplpay.cache import CacheBackend
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# -----------------------------------------------------------------------------
+class RedisCache(CacheBackend):
+    '''
+    Cache kept in Redis (or anything else speaking its protocol), so every
+    process and host running the server shares it. Values are stored as JSON
+    along with the time they go stale, and Redis drops them once their
+    grace period is over. Should Redis be unreachable, lookups miss and
+    stores are dropped rather than failing requests.
+    '''
+    def __init__(self, url, l, ttl=60, grace=0, prefix='symplpay:', clock=time.time):
+        '''
+        Constructor
+        :param url: Redis URL, e.g. redis://localhost:6379/0
+        :param l: Python logger
+        :param ttl: time in seconds an entry stays fresh for
+        :param grace: time in seconds an entry is kept around after going
+                      stale. See CacheBackend.lookup
+        :param prefix: prepended to every key, so several caches can share
+                       a database
+        :param clock: function returning the current UNIX time. Must agree
+                      across processes
+        :return: Instance of this class.
+        '''
+        if redis is None:
+            raise ImportError('RedisCache requires the "redis" package. Please run "pip install redis".')
+
+        self.redis = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+        self.l = l
+        self.ttl = ttl
+        self.grace = grace
+        self.prefix = prefix
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def lookup(self, key):
+        '''
+        See CacheBackend.lookup
+        '''
+        return self.lookup_many([key])[0]
+
+    def lookup_many(self, keys):
+        '''
+        See CacheBackend.lookup_many. All keys are looked up in a single
+        pipelined round trip.
+        '''
+        if not keys:
+            return []
+        try:
+            with self.redis.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.get(self.prefix + key)
+                raw_values = pipe.execute()
+        except (redis.RedisError, OSError) as e:
+            self.__error(e)
+            return [(None, False)] * len(keys)
+
+        now = self.clock()
+        results = []
+        hits = stale_hits = 0
+        for raw_value in raw_values:
+            if raw_value is None:
+                results.append((None, False))
+                continue
+            fresh_until, value = json.loads(raw_value)
+            if fresh_until <= now and not self.grace:
+                # Only when this host's clock is ahead of the one which
+                # stored the entry. Without a grace window, callers don't
+                # expect stale entries
+                results.append((None, False))
+            elif fresh_until <= now:
+                stale_hits += 1
+                results.append((value, True))
+            else:
+                hits += 1
+                results.append((value, False))
+
+        with self.lock:
+            self.hits += hits
+            self.stale_hits += stale_hits
+            self.misses += len(keys) - hits - stale_hits
+        return results
+
+    def set(self, key, value):
+        '''
+        See CacheBackend.set
+        '''
+        raw_value = json.dumps([self.clock() + self.ttl, value], separators=(',', ':'))
+        try:
+            self.redis.set(self.prefix + key, raw_value, px=max(1, int((self.ttl + self.grace) * 1000)))
+        except (redis.RedisError, OSError) as e:
+            self.__error(e)
+
+    def invalidate(self, key):
+        '''
+        See CacheBackend.invalidate
+        '''
+        try:
+            self.redis.delete(self.prefix + key)
+        except (redis.RedisError, OSError) as e:
+            self.__error(e)
+
+    def clear(self):
+        '''
+        Drops every entry under our prefix.
+        :return: Nothing
+        '''
+        try:
+            keys = []
+            for key in self.redis.scan_iter(match=self.prefix + '*', count=500):
+                keys.append(key)
+                if len(keys) == 500:
+                    self.redis.delete(*keys)
+                    keys = []
+            if keys:
+                self.redis.delete(*keys)
+        except (redis.RedisError, OSError) as e:
+            self.__error(e)
+
+    def stats(self):
+        '''
+        See CacheBackend.stats
+        '''
+        with self.lock:
+            return {
+                'backend': 'redis',
+                'ttl': self.ttl,
+                'grace': self.grace,
+                'hits': self.hits,
+                'staleHits': self.stale_hits,
+                'misses': self.misses,
+                'errors': self.errors
+            }
+
+    def __error(self, e):
+        '''
+        :param e: exception raised talking to Redis
+        :return: Nothing
+        '''
+        with self.lock:
+            self.errors += 1
+        self.l.error(f'Redis cache unavailable: {e}')
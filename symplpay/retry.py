@@ -0,0 +1,197 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+import random
+import threading
+from time import monotonic
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# -----------------------------------------------------------------------------
+class RetryBudget(object):
+    '''
+    Caps retries to a fraction of primary (first attempt) traffic over a
+    sliding window, so that retries can never pile onto an upstream
+    brownout.
+    '''
+    def __init__(self, ratio=0.2, min_per_second=1, window=10, clock=monotonic):
+        '''
+        Constructor
+        :param ratio: retries allowed per primary request
+        :param min_per_second: retries always allowed per second, so that
+                               low-traffic processes can still retry
+        :param window: time in seconds traffic is remembered for
+        :param clock: function returning the current time in seconds
+        :return: Instance of this class.
+        '''
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = window
+        self.clock = clock
+
+        # whole second -> [primary requests, retries]
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.denied = 0
+
+    def record_request(self):
+        '''
+        Records a primary request.
+        :return: Nothing
+        '''
+        with self.lock:
+            self.__bucket()[0] += 1
+
+    def try_spend(self):
+        '''
+        Records a retry if the budget allows for it.
+        :return: True if the retry may go ahead
+        '''
+        with self.lock:
+            bucket = self.__bucket()
+            requests = sum(x[0] for x in self.buckets.values())
+            retries = sum(x[1] for x in self.buckets.values())
+            if retries >= self.ratio * requests + self.min_per_second * self.window:
+                self.denied += 1
+                return False
+            bucket[1] += 1
+            return True
+
+    def stats(self):
+        '''
+        :return: dictionary of counters suitable for monitoring
+        '''
+        with self.lock:
+            self.__bucket()
+            return {
+                'ratio': self.ratio,
+                'requests': sum(x[0] for x in self.buckets.values()),
+                'retries': sum(x[1] for x in self.buckets.values()),
+                'denied': self.denied
+            }
+
+    def __bucket(self):
+        '''
+        Must be called with the lock held.
+        :return: counters for the current second, dropping expired ones
+        '''
+        now = int(self.clock())
+        for second in [x for x in self.buckets if x <= now - self.window]:
+            del self.buckets[second]
+        return self.buckets.setdefault(now, [0, 0])
+
+# Retries of every client in this process count against the same budget
+# unless told otherwise
+DEFAULT_BUDGET = RetryBudget()
+
+# -----------------------------------------------------------------------------
+class RetryPolicy(object):
+    '''
+    Decides whether and when a failed upstream request is retried:
+    exponential backoff with full jitter, limited to configured status
+    classes and connection errors, honoring Retry-After and a RetryBudget.
+    '''
+    def __init__(self, max_attempts=3, base_sleep=1, max_sleep=30, multiplier=2,
+                 jitter=True, retry_statuses=('429', '5xx'), retry_connection_errors=True,
+                 budget=DEFAULT_BUDGET):
+        '''
+        Constructor
+        :param max_attempts: maximum number of attempts, including the first
+        :param base_sleep: time in seconds slept before the first retry
+        :param max_sleep: upper bound on the time slept between attempts. A
+                          Retry-After asking for longer than this ends retries
+        :param multiplier: growth factor of the sleep after each attempt
+        :param jitter: sleep a random time between 0 and the backoff rather
+                       than the backoff itself
+        :param retry_statuses: HTTP statuses worth retrying, either exact
+                               ("429") or whole classes ("5xx")
+        :param retry_connection_errors: retry connection errors and timeouts
+        :param budget: RetryBudget shared with other policies. None for no limit
+        :return: Instance of this class.
+        '''
+        self.max_attempts = max_attempts
+        self.base_sleep = base_sleep
+        self.max_sleep = max_sleep
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+        self.retry_connection_errors = retry_connection_errors
+        self.budget = budget
+
+    def record_request(self):
+        '''
+        Must be called once per primary request.
+        :return: Nothing
+        '''
+        if self.budget is not None:
+            self.budget.record_request()
+
+    def retries_status(self, status):
+        '''
+        :param status: HTTP status of a failed response
+        :return: True if the status is worth retrying
+        '''
+        status = str(status)
+        return any(status == x or (x.endswith('xx') and status[0] == x[0])
+                   for x in self.retry_statuses)
+
+    def retry_delay(self, attempt, retry_after=None):
+        '''
+        :param attempt: zero-based number of the attempt which just failed
+        :param retry_after: value of the failed response's Retry-After header
+        :return: time in seconds to sleep before retrying or None if we
+                 should give up
+        '''
+        if attempt + 1 >= self.max_attempts:
+            return None
+
+        delay = min(self.max_sleep, self.base_sleep * self.multiplier ** attempt)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+
+        if retry_after is not None:
+            retry_after = parse_retry_after(retry_after)
+            if retry_after is not None:
+                if retry_after > self.max_sleep:
+                    return None
+                delay = max(delay, retry_after)
+
+        if self.budget is not None and not self.budget.try_spend():
+            return None
+        return delay
+
+# --HELPER FUNCTIONS ----------------------------------------------------------
+def parse_retry_after(value):
+    '''
+    :param value: Retry-After header, either in seconds or an HTTP date
+    :return: time in seconds to wait or None if unparsable
+    '''
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
@@ -22,17 +22,40 @@
 # SOFTWARE.
 # -----------------------------------------------------------------------------
 
+import sys
+from argparse import ArgumentParser
+
+# The gevent server needs to patch some modules before they are imported.
+# This is why we peek at the command-line here but handle it later
+if __name__ == "__main__":
+    _server_parser = ArgumentParser(add_help=False)
+    _server_parser.add_argument('--server')
+    if _server_parser.parse_known_args()[0].server == 'gevent':
+        try:
+            import gevent.monkey; gevent.monkey.patch_all()
+        except ImportError as e:
+            print('The "gevent" package is unavailable on this system!')
+            print('Please run "pip install gevent" and try starting the server again;)')
+            sys.exit(1)
+
 import os
 import logging
 import http.client
 from urllib.error import HTTPError
-from argparse import ArgumentParser
+from urllib.parse import quote
 from datetime import datetime
 import ssl
 
 try:
     from symplpay import *
-    from symplpay.client import Client
+    from symplpay.client import Client, sections_for
+    from symplpay.cache import TTLCache
+    from symplpay.retry import RetryPolicy, RetryBudget
+    from symplpay.breaker import CircuitBreakers
+    from symplpay.hedge import HedgePolicy
+    from symplpay.token import FileTokenCache
+    from symplpay.shared import Sidecar, SharedCache, SharedTokenCache
+    from symplpay.rediscache import RedisCache
 except ImportError as e:
     print('Someone forgot to "PYTHONPATH=.;export PYTHONPATH" prior to running this script! Try again;)')
     sys.exit(1)
@@ -50,17 +73,26 @@ class Server(object):
     Composite Controller class.
     Handles incoming HTTP requests.
     '''
-    def __init__(self, c, l, debug):
+    def __init__(self, c, l, debug, batch_concurrency=10, batch_max=1000, request_timeout=None):
         '''
         Constructor
         :param c: REST API client object to delegate incoming API calls to.
         :param l: Logger instance.
         :param debug: Running in Production environment?
+        :param batch_concurrency: maximum number of users a batch request
+                                  works on at once
+        :param batch_max: maximum number of users per batch request
+        :param request_timeout: default time in seconds the REMOTE calls behind
+                                a composite request must be done in. None
+                                waits forever
         :return: Instance of this class.
         '''
         self.c = c
         self.l = l
         self.debug = debug
+        self.batch_concurrency = batch_concurrency
+        self.batch_max = batch_max
+        self.request_timeout = request_timeout
         self.l.info('symplpay server initialized!')
 
     # --REST APIs--------------------------------------------------------------
@@ -81,6 +113,19 @@ class Server(object):
         :param deviceState: limit devices to those matching this state.
         Note that this is *not* a Python parameter; instead it's yanked
         out of the request's query (bottle framework limitation)
+        :param X-Request-Timeout: optional request header giving the time in
+        seconds the caller is willing to wait. Replies with a 504 once it
+        runs out
+        :param fields: comma-separated sections ("creditCards", "devices") to
+        include. The REMOTE calls behind the others are skipped. Yanked out
+        of the request's query like the states
+        :param If-None-Match: optional request header. Replies with a 304 if
+        it holds the response's ETag, which it does straight from the cache
+        while the cache is fresh
+        :param stream: "json" writes the response out as the REMOTE pages
+        arrive rather than once they all have, without an ETag. A failure
+        part way through cuts the response short. Yanked out of the
+        request's query like the states
         :return: Composite JSON response of the the REST calls. Example:
 
         '''
@@ -88,22 +133,227 @@ class Server(object):
         deviceState = bottle.request.query.get("deviceState")
         self.l.debug(f'compositeUsers: {userId}, {creditCardState}, {deviceState}')
         try:
-            ret_val = c.composite_users(userId, creditCardState, deviceState,
-                                        bottle.request.url)
-        except HTTPError as e:
-            ret_val = bottle.HTTPResponse(status=e.code, 
-                                          body={'error': 'general' if e.code not in http.client.responses else http.client.responses[e.code],
-                                                'error_description': e.reason}
-                                          )
+            timeout = self.__request_timeout()
+            fields = self.__fields()
+        except ValueError as e:
+            return bottle.HTTPResponse(status=400, body={'error': 'bad request',
+                                                         'error_description': str(e)})
+        try:
+            if bottle.request.query.get('stream') == 'json':
+                chunks = self.c.iter_composite_users_json(userId, creditCardState, deviceState,
+                                                          bottle.request.url, timeout=timeout,
+                                                          fields=fields)
+                bottle.response.content_type = 'application/json'
+                return self.__stream(userId, chunks)
+            # Already encoded, so bottle writes it out as-is
+            ret_val, etag = self.c.composite_users_json(userId, creditCardState, deviceState,
+                                                        bottle.request.url, timeout=timeout,
+                                                        fields=fields)
+            if self.__etag_matches(bottle.request.headers.get('If-None-Match'), etag):
+                ret_val = bottle.HTTPResponse(status=304, headers={'ETag': etag})
+            else:
+                bottle.response.content_type = 'application/json'
+                bottle.response.set_header('ETag', etag)
         except Exception as e:
-            # Should never happen, but just in case...
-            ret_val = bottle.HTTPResponse(status=500, 
-                                          body={'error': 'internal server error',
-                                                'error_description': str(e)}
-                                          )
+            ret_val = bottle.HTTPResponse(status=self.__error_status(e), body=self.__error_body(e))
 
         return ret_val
 
+    def batchCompositeUsers(self):
+        '''
+        Batch flavor of compositeUsers:
+            POST http://localhost:8080/compositeUsers
+
+        The request body is either a JSON list of user IDs or a JSON object:
+        {
+          "userIds": ["<user_id>", ...],
+          "creditCardState": "<optional credit card state>",
+          "deviceState": "<optional device state>"
+        }
+        The state filters may also be given in the request's query. An
+        X-Request-Timeout header applies to each user separately.
+
+        Large batches can be streamed as newline-delimited JSON instead by
+        adding "stream=ndjson" to the request's query or by accepting
+        "application/x-ndjson". One line is written per user as soon as its
+        composite result is ready, in completion order:
+            {"userId": "<user_id>", "result": <see compositeUsers>}
+            {"userId": "<user_id>", "error": {"status": <HTTP status>, "error": "...", "error_description": "..."}}
+
+        :return: JSON response mapping each user ID to either its composite
+        result or its error. A bad user ID doesn't fail the whole batch:
+        {
+          "_links": {"self": {"href": "<request URL>"}},
+          "totalResults": <number of composite results>,
+          "results": {"<user_id>": <see compositeUsers>, ...},
+          "totalErrors": <number of errors>,
+          "errors": {"<user_id>": {"status": <HTTP status>, "error": "...", "error_description": "..."}, ...}
+        }
+        '''
+        try:
+            batch = self.__parse_batch()
+            timeout = self.__request_timeout()
+        except ValueError as e:
+            return bottle.HTTPResponse(status=400, body={'error': 'bad request',
+                                                         'error_description': str(e)})
+        user_ids, creditCardState, deviceState = batch
+        self.l.debug(f'batchCompositeUsers: {len(user_ids)} users, {creditCardState}, {deviceState}')
+
+        composites = self.c.iter_composite_users(user_ids, creditCardState, deviceState,
+                                                 self.__given_url_builder(),
+                                                 self.batch_concurrency, timeout)
+        if (bottle.request.query.get('stream') == 'ndjson' or
+                'application/x-ndjson' in bottle.request.headers.get('Accept', '')):
+            bottle.response.content_type = 'application/x-ndjson'
+            return self.__ndjson(composites)
+
+        results = {}
+        errors = {}
+        for user_id, result, e in composites:
+            if e is None:
+                results[user_id] = result
+            else:
+                errors[user_id] = dict(status=self.__error_status(e), **self.__error_body(e))
+
+        return {
+            '_links': {'self': {'href': bottle.request.url}},
+            'totalResults': len(results),
+            'results': results,
+            'totalErrors': len(errors),
+            'errors': errors
+        }
+
+    def stats(self):
+        '''
+        Client counters (cache hits/misses/etc.). Useful for monitoring.
+        :return: JSON dictionary
+        '''
+        return self.c.stats()
+
+    # --HELPERS----------------------------------------------------------------
+    def __parse_batch(self):
+        '''
+        Pulls the user IDs and state filters out of a batch request.
+        :return: tuple of user IDs, credit card state and device state
+        :raises ValueError: on a malformed request
+        '''
+        batch = bottle.request.json
+        creditCardState = bottle.request.query.get("creditCardState")
+        deviceState = bottle.request.query.get("deviceState")
+        if isinstance(batch, dict):
+            creditCardState = batch.get('creditCardState', creditCardState)
+            deviceState = batch.get('deviceState', deviceState)
+            batch = batch.get('userIds')
+
+        if not isinstance(batch, list) or not all(isinstance(x, str) for x in batch):
+            raise ValueError('Expected a JSON list of user IDs (Content-Type: application/json).')
+        if len(batch) > self.batch_max:
+            raise ValueError(f'At most {self.batch_max} user IDs may be given per request.')
+        return batch, creditCardState, deviceState
+
+    def __ndjson(self, composites):
+        '''
+        Streams batch results out one line at a time so that memory use
+        doesn't grow with the size of the batch.
+        :param composites: generator returned by the client's iter_composite_users
+        :return: generator of newline-delimited JSON lines
+        '''
+        for user_id, result, e in composites:
+            if e is None:
+                line = {'userId': user_id, 'result': result}
+            else:
+                line = {'userId': user_id,
+                        'error': dict(status=self.__error_status(e), **self.__error_body(e))}
+            yield self.c.json_dumps(line) + b'\n'
+
+    def __stream(self, user_id, chunks):
+        '''
+        The status line is long gone by the time a streamed response fails,
+        so all that's left to do is log it and cut the response short.
+        :param user_id: ID of the user being streamed
+        :param chunks: generator returned by the client's iter_composite_users_json
+        :return: generator of JSON encoded bytes
+        '''
+        try:
+            yield from chunks
+        except Exception as e:
+            self.l.error(f'Streamed compositeUsers for {user_id} failed part way through: {e}')
+
+    def __fields(self):
+        '''
+        :return: sections of the composite result the current request wants
+                 or None for all of them
+        :raises ValueError: on unknown sections
+        '''
+        fields = bottle.request.query.get('fields')
+        if fields is None:
+            return None
+        return sections_for([field.strip() for field in fields.split(',') if field.strip()])
+
+    def __etag_matches(self, if_none_match, etag):
+        '''
+        :param if_none_match: If-None-Match request header or None
+        :param etag: strong ETag of the response
+        :return: True if the caller already holds the response
+        '''
+        if if_none_match is None:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        # If-None-Match uses the weak comparison function
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+
+    def __request_timeout(self):
+        '''
+        The X-Request-Timeout header may shorten, but never extend, the
+        server's default timeout.
+        :return: time in seconds the current request's REMOTE calls must be
+                 done in or None
+        :raises ValueError: on a malformed X-Request-Timeout header
+        '''
+        timeout = bottle.request.headers.get('X-Request-Timeout')
+        if timeout is None:
+            return self.request_timeout
+        try:
+            timeout = float(timeout)
+        except ValueError:
+            raise ValueError('X-Request-Timeout must be a number of seconds.')
+        if timeout <= 0:
+            raise ValueError('X-Request-Timeout must be positive.')
+        return timeout if self.request_timeout is None else min(timeout, self.request_timeout)
+
+    def __given_url_builder(self):
+        '''
+        :return: function mapping a user ID within the current batch request
+                 to the URL of the equivalent compositeUsers request
+        '''
+        parts = bottle.request.urlparts
+        base_url = f'{parts.scheme}://{parts.netloc}{parts.path.rstrip("/")}'
+        # Everything but the batch-only "stream" parameter carries over
+        query = '&'.join(x for x in parts.query.split('&') if x and not x.startswith('stream='))
+        query = f'?{query}' if query else ''
+        return lambda user_id: f'{base_url}/{quote(user_id, safe="")}{query}'
+
+    def __error_status(self, e):
+        '''
+        :param e: exception raised by the REST API client
+        :return: HTTP status to report it with
+        '''
+        # Anything but an HTTPError should never happen, but just in case...
+        return e.code if isinstance(e, HTTPError) else 500
+
+    def __error_body(self, e):
+        '''
+        :param e: exception raised by the REST API client
+        :return: JSON error body
+        '''
+        if isinstance(e, HTTPError):
+            return {'error': 'general' if e.code not in http.client.responses else http.client.responses[e.code],
+                    'error_description': e.reason}
+        return {'error': 'internal server error',
+                'error_description': str(e)}
+
     # --HTML VIEWS-------------------------------------------------------------
     def main(self):
         '''
@@ -169,6 +419,156 @@ if __name__ == "__main__":
                         help="TCP port to run this server from.",
                         type=int,
                         default=8080)
+    parser.add_argument("--max_in_flight",
+                        help="Maximum number of concurrent upstream requests per composite call.",
+                        type=int,
+                        default=1)
+    parser.add_argument("--request_timeout",
+                        help="Seconds the upstream calls behind a composite request must be done in, retries included. "
+                             "Callers may ask for less with an X-Request-Timeout header. 0 waits forever.",
+                        type=float,
+                        default=30)
+    parser.add_argument("--batch_concurrency",
+                        help="Maximum number of users a batch compositeUsers request works on at once.",
+                        type=int,
+                        default=10)
+    parser.add_argument("--batch_max",
+                        help="Maximum number of users per batch compositeUsers request.",
+                        type=int,
+                        default=1000)
+    parser.add_argument("--max_workers",
+                        help="Size of the pool shared by all composite calls for concurrent upstream requests. "
+                             "Defaults to 1000 with the gevent server, where workers are cheap greenlets.",
+                        type=int,
+                        default=None)
+    parser.add_argument("--cache_ttl",
+                        help="Seconds to cache upstream results per user ID. 0 disables the cache.",
+                        type=float,
+                        default=0)
+    parser.add_argument("--cache_size",
+                        help="Maximum number of user IDs held in the cache.",
+                        type=int,
+                        default=1024)
+    parser.add_argument("--cache_grace",
+                        help="Seconds past --cache_ttl during which cached results are still served "
+                             "while being refreshed in the background.",
+                        type=float,
+                        default=0)
+    parser.add_argument("--redis_url",
+                        help="Keep the cache (see --cache_ttl) in Redis, e.g. redis://localhost:6379/0, "
+                             "so every process and host shares it. Requires the \"redis\" package.",
+                        default=None)
+    parser.add_argument("--etag_cache_size",
+                        help="Number of upstream results kept to be revalidated with If-None-Match when the "
+                             "upstream sends ETags. Results are kept as the upstream sent them for up to a day. "
+                             "0 disables conditional upstream requests.",
+                        type=int,
+                        default=0)
+    parser.add_argument("--page_size",
+                        help="Number of credit cards or devices asked of the upstream per page. Every page is "
+                             "read regardless. 0 leaves the page size up to the upstream.",
+                        type=int,
+                        default=0)
+    parser.add_argument("--exclude_states",
+                        action='store_true',
+                        help='Have the upstream leave out credit cards and devices in unwanted states '
+                             '("excludeState"), based on the states seen so far. Only applies to results '
+                             'which are not cached.')
+    parser.add_argument("--states_ttl",
+                        help="Seconds the credit card and device states seen are trusted for before being "
+                             "relearned in the background. See --exclude_states.",
+                        type=float,
+                        default=3600)
+    parser.add_argument("--incremental_json",
+                        action='store_true',
+                        help='Parse upstream credit card and device results as they are read, keeping only '
+                             'the fields composite results are made of. Requires the "ijson" package.')
+    parser.add_argument("--retry_max_sleep",
+                        help="Upper bound in seconds on the backoff between upstream retries.",
+                        type=float,
+                        default=30)
+    parser.add_argument("--retry_budget",
+                        help="Upstream retries allowed per primary upstream request, process-wide.",
+                        type=float,
+                        default=0.2)
+    parser.add_argument('--circuit_breaker',
+                        dest='circuit_breaker',
+                        default=False,
+                        action='store_true',
+                        help='Fail fast with a 503 while an upstream endpoint is unhealthy.')
+    parser.add_argument("--breaker_error_rate",
+                        help="Fraction of failed upstream calls which opens an endpoint's circuit breaker.",
+                        type=float,
+                        default=0.5)
+    parser.add_argument("--breaker_slow_call",
+                        help="Seconds after which an upstream call counts as slow. "
+                             "Half of all calls being slow also opens the circuit breaker.",
+                        type=float,
+                        default=5)
+    parser.add_argument("--breaker_open_for",
+                        help="Seconds an open circuit breaker rejects calls before trying again.",
+                        type=float,
+                        default=30)
+    parser.add_argument("--hedge_percentile",
+                        help="Send a duplicate upstream GET once the first has taken longer than this "
+                             "percentile of recent latencies. 0 disables hedging.",
+                        type=float,
+                        default=0)
+    parser.add_argument("--hedge_budget",
+                        help="Hedged upstream GETs allowed per primary upstream GET.",
+                        type=float,
+                        default=0.05)
+    parser.add_argument("--pool_maxsize",
+                        help="Maximum number of pooled connections per upstream host.",
+                        type=int,
+                        default=10)
+    parser.add_argument("--pool_connections",
+                        help="Number of upstream hosts to keep connection pools for.",
+                        type=int,
+                        default=10)
+    parser.add_argument('--pool_block',
+                        dest='pool_block',
+                        default=False,
+                        action='store_true',
+                        help='Never open more than --pool_maxsize upstream connections; wait for a pooled one instead.')
+    parser.add_argument('--no_keep_alive',
+                        dest='keep_alive',
+                        default=True,
+                        action='store_false',
+                        help='Do not send TCP keep-alive probes on idle upstream connections.')
+    parser.add_argument("--prewarm",
+                        help="Number of upstream connections to open at startup.",
+                        type=int,
+                        default=0)
+    parser.add_argument("--token_refresh_margin",
+                        help="Seconds ahead of expiry the upstream OAuth token is refreshed in the background. "
+                             "0 only refreshes it once it has expired.",
+                        type=float,
+                        default=60)
+    parser.add_argument("--token_cache",
+                        help="File the upstream OAuth token is cached in, so restarts and workers reuse it.",
+                        default=None)
+    parser.add_argument("--lazy_token",
+                        help="Start serving before the first upstream OAuth token has arrived.",
+                        action="store_true")
+    parser.add_argument("--shared_state",
+                        help="Unix socket over which all gunicorn workers share one upstream OAuth token and "
+                             "one cache (see \"--cache_ttl\"). Served from the master process.",
+                        default=None)
+    parser.add_argument("--workers",
+                        help="Number of gunicorn worker processes. Only applies with \"--ssl\", which always "
+                             "runs on gunicorn.",
+                        type=int,
+                        default=1)
+    parser.add_argument("--json_encoder",
+                        help="JSON encoder for responses. \"auto\" picks the fastest one installed.",
+                        choices=['auto', 'orjson', 'ujson', 'json'],
+                        default='auto')
+    parser.add_argument('--speculative',
+                        dest='speculative',
+                        default=False,
+                        action='store_true',
+                        help='Guess the creditCards and devices URLs and fetch them alongside the user.')
     parser.add_argument("--log_file",
                         help="Text log file location.",
                         type=str,
@@ -183,7 +583,15 @@ if __name__ == "__main__":
                         default=False,
                         action='store_true',
                         help='Accept HTTPS in addition to HTTP.')
+    parser.add_argument('--server',
+                        help='Web server to run on. "gevent" serves every request from a greenlet on a single '
+                             'event loop, with upstream calls made non-blocking. The "--ssl" flag always uses '
+                             'gunicorn, with gevent workers if "gevent" is chosen here.',
+                        choices=['wsgiref', 'gevent'],
+                        default='wsgiref')
     args = parser.parse_args()
+    if args.server == 'gevent' and args.max_workers is None:
+        args.max_workers = 1000
     args.log_file = os.path.abspath(args.log_file)
 
     # We want file logs as well------------------------------------------------
@@ -197,7 +605,8 @@ if __name__ == "__main__":
         'host': 'localhost', 
         'port': args.port, 
         'debug': args.debug,
-        'quiet': True
+        'quiet': True,
+        'server': args.server
     }
 
     # HTTPS support is "fun" from bottle---------------------------------------
@@ -216,11 +625,54 @@ if __name__ == "__main__":
 
         l.warn(f'Monkey-patching command-line args for gunicorn')
         sys.argv = sys.argv[:1]
+        if args.server == 'gevent':
+            bottle_args['worker_class'] = 'gevent'
         bottle_args['server'] = 'gunicorn'
+        bottle_args['workers'] = args.workers
 
     # -- Configure the web server ---------------------------------------------
-    c = Client(args.client_id, args.client_secret, args.base_url, args.token_url, l)
-    s = Server(c, l, args.debug)
+    if args.cache_ttl <= 0:
+        cache = None
+    elif args.redis_url is not None:
+        cache = RedisCache(args.redis_url, l, args.cache_ttl, args.cache_grace)
+    else:
+        cache = TTLCache(args.cache_ttl, args.cache_size, args.cache_grace)
+    token_cache = None if args.token_cache is None else FileTokenCache(args.token_cache, l)
+    if args.shared_state is not None:
+        # Workers forked from here on reach the sidecar's copies instead.
+        # Redis is shared already
+        local_cache = cache if isinstance(cache, TTLCache) else None
+        shared = Sidecar(args.shared_state, l, local_cache).start().connect()
+        if local_cache is not None:
+            cache = SharedCache(shared, l, args.cache_grace)
+        token_cache = SharedTokenCache(shared, l)
+    c = Client(args.client_id, args.client_secret, args.base_url, args.token_url, l,
+               max_in_flight=args.max_in_flight, max_workers=args.max_workers,
+               speculative=args.speculative,
+               pool_connections=args.pool_connections,
+               pool_maxsize=args.pool_maxsize, pool_block=args.pool_block,
+               keep_alive=args.keep_alive, prewarm=args.prewarm,
+               token_refresh_margin=args.token_refresh_margin,
+               token_cache=token_cache,
+               lazy_token=args.lazy_token,
+               json_dumps=json_encoder(args.json_encoder),
+               etag_cache_size=args.etag_cache_size,
+               page_size=args.page_size if args.page_size > 0 else None,
+               exclude_states=args.exclude_states, states_ttl=args.states_ttl,
+               incremental_json=args.incremental_json,
+               cache=cache,
+               retry_policy=RetryPolicy(max_sleep=args.retry_max_sleep, budget=RetryBudget(args.retry_budget)),
+               breakers=CircuitBreakers(error_rate=args.breaker_error_rate,
+                                        slow_call=args.breaker_slow_call,
+                                        open_for=args.breaker_open_for) if args.circuit_breaker else None,
+               hedge_policy=HedgePolicy(args.hedge_percentile,
+                                        budget=RetryBudget(args.hedge_budget, min_per_second=0)) if args.hedge_percentile > 0 else None)
+    s = Server(c, l, args.debug, args.batch_concurrency, args.batch_max,
+               args.request_timeout if args.request_timeout > 0 else None)
+
+    # Dictionaries returned by routes are encoded with the same encoder
+    bottle.uninstall('json')
+    bottle.install(bottle.JSONPlugin(json_dumps=c.json_dumps))
 
     # Initialize routes
     bottle.get("/")(s.main)
@@ -228,6 +680,8 @@ if __name__ == "__main__":
     bottle.route('/static/:file_path#.+#')(s.static)
     bottle.get("/favicon.ico")(s.get_favicon)
     bottle.get('/compositeUsers/<userId>')(s.compositeUsers)
+    bottle.post('/compositeUsers')(s.batchCompositeUsers)
+    bottle.get('/stats')(s.stats)
 
     # Start honoring requests!
     l.info(f'Server logs may also be found online at http{"s" if args.ssl else ""}://localhost:{args.port}/logs')
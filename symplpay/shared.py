@@ -0,0 +1,371 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+import os
+import threading
+from contextlib import contextmanager
+from itertools import count
+from multiprocessing.connection import Listener, Client as Connect
+from multiprocessing import AuthenticationError
+from time import monotonic
+
+from symplpay.cache import CacheBackend
+
+# -----------------------------------------------------------------------------
+class TokenSlot(object):
+    '''
+    OAuth token shared by every process connected to a Sidecar, plus a lease
+    making sure only one of them fetches a new token at a time. Leases
+    expire, so a process dying mid-fetch doesn't lock the others out.
+    '''
+    def __init__(self, lease=30, clock=monotonic):
+        '''
+        Constructor
+        :param lease: time in seconds a holder may keep the slot locked for
+        :param clock: function returning the current time in seconds
+        :return: Instance of this class.
+        '''
+        self.lease = lease
+        self.clock = clock
+
+        self.token = None
+        self.holder = None
+        self.held_until = 0
+        self.leases = count(1)
+        self.condition = threading.Condition()
+
+    def load(self):
+        '''
+        :return: the shared token or None
+        '''
+        return self.token
+
+    def store(self, token):
+        '''
+        :param token: token's dictionary
+        :return: Nothing
+        '''
+        self.token = token
+
+    def acquire(self):
+        '''
+        Blocks until the slot is free (or its holder's lease ran out).
+        :return: lease identifier to hand to release
+        '''
+        with self.condition:
+            while self.holder is not None and self.held_until > self.clock():
+                self.condition.wait(self.held_until - self.clock())
+            self.holder = next(self.leases)
+            self.held_until = self.clock() + self.lease
+            return self.holder
+
+    def release(self, holder):
+        '''
+        :param holder: lease identifier returned by acquire. Expired leases
+                       are ignored
+        :return: Nothing
+        '''
+        with self.condition:
+            if self.holder == holder:
+                self.holder = None
+                self.condition.notify()
+
+# -----------------------------------------------------------------------------
+class Sidecar(object):
+    '''
+    Serves a TTLCache and a TokenSlot to other processes over a unix socket.
+    Started in gunicorn's master process, it lets every pre-forked worker
+    share one token and one cache of composite payloads.
+    '''
+    # Methods callers may invoke, per shared object
+    exposed = {
+        'cache': ('get', 'lookup', 'lookup_many', 'set', 'invalidate', 'clear', 'stats'),
+        'token': ('load', 'store', 'acquire', 'release')
+    }
+
+    def __init__(self, address, l, cache=None, lease=30, authkey=None):
+        '''
+        Constructor
+        :param address: path of the unix socket to listen on. A stale socket
+                        left behind at this path is replaced
+        :param l: Python logger
+        :param cache: TTLCache to share. None only shares the token
+        :param lease: time in seconds a process may take to fetch a token
+        :param authkey: secret callers must know. Defaults to a random one,
+                        which forked children inherit
+        :return: Instance of this class.
+        '''
+        self.address = address
+        self.l = l
+        self.authkey = authkey or os.urandom(32)
+        self.targets = {'cache': cache, 'token': TokenSlot(lease)}
+        self.listener = None
+
+    def start(self):
+        '''
+        Listens for callers on a background thread.
+        :return: This instance
+        '''
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self.listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        os.chmod(self.address, 0o600)
+        threading.Thread(target=self.__accept, name='symplpay-sidecar', daemon=True).start()
+        self.l.info(f'Sharing state over {self.address}')
+        return self
+
+    def stop(self):
+        '''
+        Stops accepting callers.
+        :return: Nothing
+        '''
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.close()
+
+    def connect(self):
+        '''
+        :return: SharedState talking to this sidecar
+        '''
+        return SharedState(self.address, self.l, self.authkey)
+
+    def __accept(self):
+        '''
+        Accept loop. Every caller gets a thread of its own.
+        :return: Nothing
+        '''
+        while self.listener is not None:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError) as e:
+                if self.listener is not None:
+                    self.l.error(f'Rejected shared state caller: {e}')
+                continue
+            threading.Thread(target=self.__serve, args=(conn,), daemon=True).start()
+
+    def __serve(self, conn):
+        '''
+        Answers one caller's requests until it hangs up.
+        :param conn: connection to the caller
+        :return: Nothing
+        '''
+        with conn:
+            while True:
+                try:
+                    target, method, args = conn.recv()
+                except (OSError, EOFError):
+                    return
+                try:
+                    if self.targets.get(target) is None or method not in self.exposed[target]:
+                        raise ValueError(f'{target}.{method} is not shared')
+                    reply = (True, getattr(self.targets[target], method)(*args))
+                except Exception as e:
+                    reply = (False, e)
+                try:
+                    conn.send(reply)
+                except OSError:
+                    return
+
+# -----------------------------------------------------------------------------
+class SharedState(object):
+    '''
+    Caller side of a Sidecar. Connections are pooled per process: children
+    forked after connecting (e.g. gunicorn workers) open their own rather
+    than sharing their parent's.
+    '''
+    def __init__(self, address, l, authkey):
+        '''
+        Constructor
+        :param address: path of the Sidecar's unix socket
+        :param l: Python logger
+        :param authkey: the Sidecar's secret
+        :return: Instance of this class.
+        '''
+        self.address = address
+        self.l = l
+        self.authkey = authkey
+
+        self.pid = os.getpid()
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def call(self, target, method, *args):
+        '''
+        :param target: shared object; "cache" or "token"
+        :param method: name of the method to invoke on it
+        :param args: method arguments
+        :return: what the method returned. Raises what it raised, or OSError
+                 and EOFError if the sidecar can't be reached
+        '''
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.idle = []
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = Connect(self.address, family='AF_UNIX', authkey=self.authkey)
+
+        try:
+            conn.send((target, method, args))
+            ok, result = conn.recv()
+        except BaseException:
+            conn.close()
+            raise
+
+        with self.lock:
+            if self.pid == os.getpid():
+                self.idle.append(conn)
+        if not ok:
+            raise result
+        return result
+
+# -----------------------------------------------------------------------------
+class SharedCache(CacheBackend):
+    '''
+    Stand-in for a TTLCache which lives in a Sidecar, so all processes see
+    each other's entries. Should the sidecar be unreachable, lookups miss
+    and stores are dropped rather than failing requests.
+    '''
+    def __init__(self, shared, l, grace=0):
+        '''
+        Constructor
+        :param shared: SharedState
+        :param l: Python logger
+        :param grace: grace period of the sidecar's TTLCache
+        :return: Instance of this class.
+        '''
+        self.shared = shared
+        self.l = l
+        self.grace = grace
+        self.errors = 0
+
+    def get(self, key):
+        '''
+        See CacheBackend.get
+        '''
+        return self.__call('get', key)
+
+    def lookup(self, key):
+        '''
+        See CacheBackend.lookup
+        '''
+        return self.__call('lookup', key, default=(None, False))
+
+    def lookup_many(self, keys):
+        '''
+        See CacheBackend.lookup_many
+        '''
+        return self.__call('lookup_many', keys, default=[(None, False)] * len(keys))
+
+    def set(self, key, value):
+        '''
+        See CacheBackend.set
+        '''
+        self.__call('set', key, value)
+
+    def invalidate(self, key):
+        '''
+        See CacheBackend.invalidate
+        '''
+        self.__call('invalidate', key)
+
+    def clear(self):
+        '''
+        See CacheBackend.clear
+        '''
+        self.__call('clear')
+
+    def stats(self):
+        '''
+        See CacheBackend.stats
+        '''
+        stats = self.__call('stats', default={})
+        stats.update(shared=True, errors=self.errors)
+        return stats
+
+    def __call(self, method, *args, default=None):
+        '''
+        :return: what the sidecar's cache returned or default if unreachable
+        '''
+        try:
+            return self.shared.call('cache', method, *args)
+        except (OSError, EOFError, AuthenticationError) as e:
+            self.errors += 1
+            self.l.error(f'Shared cache unavailable: {e}')
+            return default
+
+# -----------------------------------------------------------------------------
+class SharedTokenCache(object):
+    '''
+    Token cache (see FileTokenCache) living in a Sidecar. Should the sidecar
+    be unreachable, processes fall back to fetching tokens on their own.
+    '''
+    def __init__(self, shared, l):
+        '''
+        Constructor
+        :param shared: SharedState
+        :param l: Python logger
+        :return: Instance of this class.
+        '''
+        self.shared = shared
+        self.l = l
+
+    @contextmanager
+    def locked(self):
+        '''
+        Holds the sidecar's token lease for as long as the context is active.
+        '''
+        try:
+            holder = self.shared.call('token', 'acquire')
+        except (OSError, EOFError, AuthenticationError) as e:
+            self.l.error(f'Shared token unavailable: {e}')
+            holder = None
+        try:
+            yield self
+        finally:
+            if holder is not None:
+                try:
+                    self.shared.call('token', 'release', holder)
+                except (OSError, EOFError, AuthenticationError):
+                    pass
+
+    def load(self):
+        '''
+        :return: the shared token or None
+        '''
+        try:
+            return self.shared.call('token', 'load')
+        except (OSError, EOFError, AuthenticationError) as e:
+            self.l.error(f'Shared token unavailable: {e}')
+            return None
+
+    def store(self, token):
+        '''
+        :param token: token's dictionary
+        :return: Nothing
+        '''
+        try:
+            self.shared.call('token', 'store', token)
+        except (OSError, EOFError, AuthenticationError) as e:
+            self.l.error(f'Shared token unavailable: {e}')
@@ -0,0 +1,113 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+import threading
+from time import monotonic
+
+# -----------------------------------------------------------------------------
+class _Call(object):
+    '''
+    A single in-flight call and, once done, its outcome.
+    '''
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+# -----------------------------------------------------------------------------
+class SingleFlight(object):
+    '''
+    Collapses concurrent calls sharing a key into one.
+    The first caller for a key does the work. Callers arriving while it's
+    still in flight wait for it and share its result (or exception), so
+    nothing is ever served stale.
+    '''
+    def __init__(self):
+        '''
+        Constructor
+        :return: Instance of this class.
+        '''
+        # key -> _Call
+        self.calls = {}
+        self.lock = threading.Lock()
+
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key, fn, *args, timeout=None, private_errors=(), **kwargs):
+        '''
+        :param key: calls sharing this key are collapsed into one
+        :param fn: function doing the actual work
+        :param timeout: time in seconds to wait on other threads' calls, in
+                        total. None waits forever
+        :param private_errors: exception types which only concern the thread
+                               that did the work (e.g., it ran out of its own
+                               time). Waiting threads try again instead of
+                               sharing them, one of them doing the work next
+        :return: fn(*args, **kwargs), possibly computed by another thread
+        :raises TimeoutError: if other threads' calls took too long
+        '''
+        give_up_at = None if timeout is None else monotonic() + timeout
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                if call is None:
+                    call = self.calls[key] = _Call()
+                    self.leaders += 1
+                    leader = True
+                else:
+                    self.followers += 1
+                    leader = False
+
+            if leader:
+                break
+            if not call.done.wait(None if give_up_at is None else max(0, give_up_at - monotonic())):
+                raise TimeoutError(f'Timed out waiting on {key}')
+            if isinstance(call.error, private_errors):
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def stats(self):
+        '''
+        :return: dictionary of counters suitable for monitoring
+        '''
+        with self.lock:
+            return {
+                'inFlight': len(self.calls),
+                'leaders': self.leaders,
+                'followers': self.followers
+            }
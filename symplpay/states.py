@@ -0,0 +1,124 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+import threading
+from time import monotonic
+
+# -----------------------------------------------------------------------------
+class ObservedStates(object):
+    '''
+    Learns which states credit cards and devices show up in, per section
+    (see client.SECTIONS). The REMOTE server filters with "excludeState"
+    only, so wanting one state means excluding every other known state.
+    States are relearned from an unfiltered collection every ttl seconds,
+    in the background. Until then, the states already known are used.
+    Thread-safe.
+    '''
+    def __init__(self, l, relearn, ttl=3600, clock=monotonic):
+        '''
+        Constructor
+        :param l: logger
+        :param relearn: function taking a section and the URL of one of its
+                        unfiltered collections and returning that collection's
+                        JSON result
+        :param ttl: time in seconds learned states are trusted for before
+                    being relearned
+        :param clock: function returning the current time in seconds
+        :return: Instance of this class.
+        '''
+        self.l = l
+        self.relearn = relearn
+        self.ttl = ttl
+        self.clock = clock
+
+        # section -> set of states, time they were last learned and the
+        # last unfiltered collection they were learned from
+        self.states = {}
+        self.learned = {}
+        self.urls = {}
+        self.relearning = set()
+        self.relearns = 0
+        self.lock = threading.Lock()
+
+    def observe(self, section, url, collection_json):
+        '''
+        :param section: section collection_json belongs to
+        :param url: URL collection_json was pulled from, without any
+                    "excludeState"
+        :param collection_json: unfiltered JSON page of a REMOTE collection
+        :return: Nothing
+        '''
+        states = {x['state'] for x in collection_json.get('results') or []}
+        with self.lock:
+            self.states.setdefault(section, set()).update(states)
+            self.learned[section] = self.clock()
+            self.urls[section] = url
+
+    def exclude(self, section, state):
+        '''
+        :param section: section being fetched
+        :param state: normalized state wanted or None for all of them
+        :return: sorted list of the known states other than state or None
+                 if nothing needs excluding or nothing is known yet
+        '''
+        if state is None:
+            return None
+        with self.lock:
+            states = self.states.get(section)
+            if not states:
+                return None
+            if self.clock() - self.learned[section] >= self.ttl and section not in self.relearning:
+                self.relearning.add(section)
+                threading.Thread(target=self.__relearn, args=(section, self.urls[section]),
+                                 daemon=True).start()
+            excluded = sorted(x for x in states if x.upper().strip() != state)
+        return excluded or None
+
+    def stats(self):
+        '''
+        :return: dictionary of counters suitable for monitoring
+        '''
+        with self.lock:
+            return {'ttl': self.ttl,
+                    'relearns': self.relearns,
+                    'states': {section: sorted(states) for section, states in self.states.items()}}
+
+    def __relearn(self, section, url):
+        '''
+        :param section: section to relearn the states of
+        :param url: unfiltered collection to relearn them from
+        :return: Nothing
+        '''
+        try:
+            self.observe(section, url, self.relearn(section, url))
+            with self.lock:
+                self.relearns += 1
+        except Exception as e:
+            # Keep going with the states already known and try again later
+            self.l.error(f'Failed to relearn the {section} states from {url}: {e}')
+            with self.lock:
+                self.learned[section] = self.clock()
+        finally:
+            with self.lock:
+                self.relearning.discard(section)
@@ -0,0 +1,328 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows. The token cache still works, but workers
+    # may race to fetch a token
+    fcntl = None
+
+# --GLOBALS--------------------------------------------------------------------
+# Least time in seconds between two background refreshes, whatever the
+# tokens' lifetimes
+MIN_REFRESH_INTERVAL = 1
+
+# -----------------------------------------------------------------------------
+class FileTokenCache(object):
+    '''
+    Persists an OAuth token to disk so restarted processes (and all of a
+    server's workers) reuse it while it's still valid instead of each
+    fetching their own. The file is only ever readable by its owner.
+    '''
+    def __init__(self, path, l):
+        '''
+        Constructor
+        :param path: file the token is stored in. A path + '.lock' file is
+                     used to serialise fetches across processes
+        :param l: Python logger
+        :return: Instance of this class.
+        '''
+        self.path = path
+        self.l = l
+
+    @contextmanager
+    def locked(self):
+        '''
+        Holds an exclusive lock across processes for as long as the context
+        is active.
+        '''
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield self
+        finally:
+            # Closing the file releases the lock
+            os.close(fd)
+
+    def load(self):
+        '''
+        :return: the cached token or None if there isn't a readable one
+        '''
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.l.error(f'Ignoring unreadable token cache {self.path}: {e}')
+            return None
+
+    def store(self, token):
+        '''
+        Atomically replaces the cached token.
+        :param token: token's dictionary
+        :return: Nothing
+        '''
+        # mkstemp creates the file with 0600 permissions
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                        prefix='.token-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(token, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            self.l.error(f'Failed to write token cache {self.path}: {e}')
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+# -----------------------------------------------------------------------------
+class TokenManager(object):
+    '''
+    Keeps an OAuth token fresh.
+    A background thread refreshes the token refresh_margin seconds (but at
+    most half its lifetime) ahead of its expiry, so request threads never
+    wait on the token endpoint. A
+    single lock makes sure only one refresh ever runs at a time; request
+    threads read the current token without taking it.
+    '''
+    def __init__(self, fetch, l, refresh_margin=60, retry_sleep=5, cache=None,
+                 on_token=None, clock=time.time):
+        '''
+        Constructor
+        :param fetch: function fetching a new token. Must return the token's
+                      dictionary
+        :param l: Python logger
+        :param refresh_margin: time in seconds ahead of expiry the token is
+                               refreshed, capped at half the token's
+                               lifetime. 0 only refreshes on demand
+        :param retry_sleep: time in seconds to wait after a failed
+                            background refresh
+        :param cache: optional FileTokenCache shared with other processes
+        :param on_token: function called with every new token, before it's
+                         made current
+        :param clock: function returning the current UNIX time
+        :return: Instance of this class.
+        '''
+        self.fetch = fetch
+        self.l = l
+        self.refresh_margin = refresh_margin
+        self.retry_sleep = retry_sleep
+        self.cache = cache
+        self.on_token = on_token
+        self.clock = clock
+
+        self.token = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.lazy = False
+        self.refreshes = 0
+        self.cache_hits = 0
+
+    def start(self, lazy=False):
+        '''
+        Gets the first token, then keeps it fresh in the background.
+        :param lazy: get the first token in the background too. Callers
+                     needing it before then block in current()
+        :return: This instance
+        '''
+        self.lazy = lazy
+        if not lazy:
+            self.current()
+        self.__start_thread()
+        if hasattr(os, 'register_at_fork'):
+            # Threads don't survive a fork (e.g. into gunicorn workers)
+            os.register_at_fork(after_in_child=self.__after_fork)
+        return self
+
+    def stop(self):
+        '''
+        Stops background refreshes.
+        :return: Nothing
+        '''
+        self.stopped.set()
+
+    def current(self):
+        '''
+        :return: current token, getting the first one if need be
+        '''
+        token = self.token
+        if token is None:
+            with self.lock:
+                if self.token is None:
+                    self.__obtain()
+                token = self.token
+        return token
+
+    def refresh(self, stale_token=None):
+        '''
+        Gets a new token, unless another thread already replaced
+        stale_token while we waited on the lock.
+        :param stale_token: the token which was found to be expired. None
+                            always refreshes
+        :return: current token
+        '''
+        with self.lock:
+            if stale_token is not None and self.token is not stale_token:
+                return self.token
+            self.__obtain()
+            return self.token
+
+    def expires_in(self, token=None):
+        '''
+        :param token: token to check. Defaults to the current one
+        :return: time in seconds until the token expires or None if unknown
+        '''
+        token = token or self.token
+        if not token or 'expires_at' not in token:
+            return None
+        return token['expires_at'] - self.clock()
+
+    def stats(self):
+        '''
+        :return: dictionary of counters suitable for monitoring
+        '''
+        return {
+            'refreshes': self.refreshes,
+            'cacheHits': self.cache_hits,
+            'expiresIn': self.expires_in()
+        }
+
+    def __obtain(self):
+        '''
+        Makes a new token current, from the cache if it holds a newer one
+        than ours which is still good for a while. Caller holds self.lock.
+        :return: Nothing
+        '''
+        if self.cache is None:
+            self.__install(self.fetch())
+            self.refreshes += 1
+            return
+
+        with self.cache.locked():
+            token = self.cache.load()
+            if self.__usable(token):
+                self.l.debug('Reusing cached token.')
+                self.__install(token)
+                self.cache_hits += 1
+                return
+            token = self.fetch()
+            self.cache.store(token)
+            self.__install(token)
+            self.refreshes += 1
+
+    def __usable(self, token):
+        '''
+        :param token: cached token
+        :return: True if token should replace the current one
+        '''
+        if not token or 'access_token' not in token:
+            return False
+        if self.token is not None and token['access_token'] == self.token.get('access_token'):
+            return False
+        expires_in = self.expires_in(token)
+        return expires_in is None or expires_in > self.__margin(token)
+
+    def __margin(self, token):
+        '''
+        :param token: token to refresh
+        :return: time in seconds ahead of token's expiry to refresh it.
+                 Tokens living no longer than refresh_margin would
+                 otherwise be refreshed as soon as they arrive
+        '''
+        try:
+            lifetime = float(token['expires_in'])
+        except (KeyError, TypeError, ValueError):
+            return self.refresh_margin
+        return min(self.refresh_margin, lifetime / 2) if lifetime > 0 else self.refresh_margin
+
+    def __install(self, token):
+        '''
+        :param token: token to make current
+        :return: Nothing
+        '''
+        if self.on_token is not None:
+            self.on_token(token)
+        self.token = token
+
+    def __start_thread(self):
+        '''
+        Starts the background refresh thread, if there's anything for it to do.
+        :return: Nothing
+        '''
+        if self.refresh_margin or self.token is None:
+            self.thread = threading.Thread(target=self.__run, name='symplpay-token', daemon=True)
+            self.thread.start()
+
+    def __after_fork(self):
+        '''
+        Restarts background refreshes in a forked child.
+        :return: Nothing
+        '''
+        # Parent threads may have held these when it forked
+        self.lock = threading.Lock()
+        stopped, self.stopped = self.stopped.is_set(), threading.Event()
+        if stopped:
+            self.stopped.set()
+        else:
+            self.__start_thread()
+
+    def __run(self):
+        '''
+        Background refresh loop.
+        :return: Nothing
+        '''
+        refreshed_at = None
+        while not self.stopped.is_set():
+            try:
+                if self.token is None:
+                    self.current()
+                    continue
+                expires_in = self.expires_in()
+                if expires_in is None or not self.refresh_margin:
+                    # Nothing to schedule against; refreshes happen on demand
+                    return
+                delay = expires_in - self.__margin(self.token)
+                if refreshed_at is not None:
+                    # Don't hammer the token endpoint if it keeps handing
+                    # out tokens which are (nearly) expired already
+                    delay = max(delay, refreshed_at + MIN_REFRESH_INTERVAL - self.clock())
+                if self.stopped.wait(max(0, delay)):
+                    return
+                self.refresh()
+                refreshed_at = self.clock()
+            except Exception as e:
+                self.l.error(f'Failed to refresh token in the background: {e}')
+                self.stopped.wait(self.retry_sleep)
@@ -0,0 +1,64 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+import socket
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+# -----------------------------------------------------------------------------
+class PoolingAdapter(HTTPAdapter):
+    '''
+    requests transport adapter with tunable connection pools and optional
+    TCP keep-alive probes, so that idle pooled connections to the REMOTE
+    server aren't silently dropped by NATs/load balancers.
+    '''
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False,
+                 keep_alive=True, keep_alive_idle=60):
+        '''
+        Constructor
+        :param pool_connections: number of hosts to keep connection pools for
+        :param pool_maxsize: maximum number of pooled connections per host
+        :param pool_block: wait for a pooled connection instead of opening
+                           (and later discarding) extra ones once
+                           pool_maxsize connections are in use
+        :param keep_alive: send TCP keep-alive probes on idle connections
+        :param keep_alive_idle: time in seconds a connection sits idle before
+                                the first probe, where the OS supports it
+        :return: Instance of this class.
+        '''
+        self.socket_options = list(HTTPConnection.default_socket_options)
+        if keep_alive:
+            self.socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                self.socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, keep_alive_idle))
+        super().__init__(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                         pool_block=pool_block)
+
+    def init_poolmanager(self, *args, **kwargs):
+        '''
+        Overridden
+        '''
+        kwargs['socket_options'] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
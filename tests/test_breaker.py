@@ -0,0 +1,93 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+import unittest
+
+from symplpay.breaker import CircuitBreaker
+
+# -----------------------------------------------------------------------------
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.breaker = CircuitBreaker('upstream', min_calls=4, open_for=30, half_open_calls=2,
+                                      clock=lambda: self.now)
+
+    def trip(self):
+        '''
+        Fails enough calls to open the breaker.
+        :return: Nothing
+        '''
+        for _ in range(4):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record(False, 0.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def half_open(self):
+        '''
+        Trips the breaker and waits out open_for.
+        :return: Nothing
+        '''
+        self.trip()
+        self.now += 29
+        self.assertFalse(self.breaker.allow())
+        self.now += 1
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+    def test_stays_closed_below_min_calls(self):
+        for _ in range(3):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record(False, 0.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_opens_on_failures(self):
+        self.trip()
+        self.assertFalse(self.breaker.allow())
+
+    def test_half_open_closes_on_successful_trials(self):
+        self.half_open()
+        self.breaker.record(True, 0.1)
+        self.assertTrue(self.breaker.allow())
+        # Only half_open_calls trial calls are let through
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(True, 0.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_half_open_reopens_on_a_failed_trial(self):
+        self.half_open()
+        self.breaker.record(False, 0.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+
+    def test_half_open_reopens_on_a_slow_trial(self):
+        self.half_open()
+        self.breaker.record(True, 5)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+if __name__ == '__main__':
+    unittest.main()
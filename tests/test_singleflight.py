@@ -0,0 +1,120 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+import threading
+import unittest
+from time import sleep
+
+from symplpay.singleflight import SingleFlight
+from symplpay.deadline import DeadlineExceeded
+
+# -----------------------------------------------------------------------------
+class SingleFlightTest(unittest.TestCase):
+
+    def follow(self, flights, fn):
+        '''
+        Starts a thread calling flights.do for the key "k" and waits until
+        it's waiting on the leader's call.
+        :return: tuple of the thread and a list receiving its result or
+                 exception
+        '''
+        outcome = []
+
+        def follower():
+            try:
+                outcome.append(flights.do('k', fn, private_errors=(DeadlineExceeded,)))
+            except Exception as e:
+                outcome.append(e)
+
+        followers = flights.stats()['followers']
+        thread = threading.Thread(target=follower, daemon=True)
+        thread.start()
+        for _ in range(1000):
+            if flights.stats()['followers'] > followers:
+                break
+            sleep(0.001)
+        self.assertEqual(flights.stats()['followers'], followers + 1)
+        return thread, outcome
+
+    def lead(self, flights, error):
+        '''
+        Calls flights.do for the key "k", having a follower join in before
+        failing with error.
+        :return: see follow
+        '''
+        calls = []
+
+        def leader():
+            calls.append('leader')
+            # The follower is only set up once the leader is in flight
+            follower[:] = self.follow(flights, lambda: calls.append('follower') or 'result')
+            raise error
+
+        follower = []
+        with self.assertRaises(type(error)):
+            flights.do('k', leader, private_errors=(DeadlineExceeded,))
+        thread, outcome = follower
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        return calls, outcome
+
+    def test_followers_share_the_result(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        thread = []
+
+        def leader():
+            thread[:] = self.follow(flights, lambda: 'follower result')
+            release.set()
+            return 'leader result'
+
+        self.assertEqual(flights.do('k', leader), 'leader result')
+        thread[0].join(5)
+        self.assertEqual(thread[1], ['leader result'])
+        self.assertEqual(flights.stats(), {'inFlight': 0, 'leaders': 1, 'followers': 1})
+
+    def test_followers_share_errors(self):
+        calls, outcome = self.lead(SingleFlight(), ValueError('boom'))
+        self.assertEqual(calls, ['leader'])
+        self.assertIsInstance(outcome[0], ValueError)
+
+    def test_followers_redo_the_call_after_private_errors(self):
+        flights = SingleFlight()
+        calls, outcome = self.lead(flights, DeadlineExceeded('http://upstream/users/1'))
+        self.assertEqual(calls, ['leader', 'follower'])
+        self.assertEqual(outcome, ['result'])
+        self.assertEqual(flights.stats()['leaders'], 2)
+
+    def test_followers_time_out(self):
+        flights = SingleFlight()
+
+        def leader():
+            with self.assertRaises(TimeoutError):
+                flights.do('k', lambda: 'never', timeout=0)
+            return 'result'
+
+        self.assertEqual(flights.do('k', leader), 'result')
+
+if __name__ == '__main__':
+    unittest.main()
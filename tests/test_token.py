@@ -0,0 +1,109 @@
+# -----------------------------------------------------------------------------
+# MIT License
+# 
+# Copyright (c) 2020 David Fugate
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+
+import logging
+import unittest
+
+from symplpay.token import TokenManager, MIN_REFRESH_INTERVAL
+
+# --HELPER CLASSES-------------------------------------------------------------
+class FakeClock(object):
+    '''
+    Clock which only moves when told to.
+    '''
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class FakeStopped(object):
+    '''
+    Stands in for TokenManager.stopped: every wait moves the clock on by
+    the time waited rather than sleeping, and stops the refresh loop after
+    a given number of waits.
+    '''
+    def __init__(self, clock, waits):
+        self.clock = clock
+        self.waits = waits
+        self.delays = []
+
+    def is_set(self):
+        return len(self.delays) >= self.waits
+
+    def wait(self, delay=None):
+        self.delays.append(delay)
+        self.clock.now += delay
+        return self.is_set()
+
+# -----------------------------------------------------------------------------
+class TokenManagerTest(unittest.TestCase):
+
+    def run_loop(self, lifetime, waits=10, refresh_margin=60):
+        '''
+        Runs the background refresh loop on the calling thread.
+        :param lifetime: "expires_in" of every token handed out
+        :return: tuple of number of tokens fetched and the loop's waits
+        '''
+        clock = FakeClock()
+        fetched = []
+
+        def fetch():
+            fetched.append(clock())
+            return {'access_token': f't{len(fetched)}', 'expires_in': lifetime,
+                    'expires_at': clock() + lifetime}
+
+        manager = TokenManager(fetch, logging.getLogger(__name__), refresh_margin=refresh_margin,
+                               clock=clock)
+        manager.current()
+        manager.stopped = FakeStopped(clock, waits)
+        manager._TokenManager__run()
+        return len(fetched), manager.stopped.delays
+
+    def test_long_lived_tokens_refresh_ahead_of_expiry(self):
+        fetched, delays = self.run_loop(3600)
+        self.assertEqual(delays, [3600 - 60] * 10)
+        self.assertEqual(fetched, 10)
+
+    def test_short_lived_tokens_refresh_halfway(self):
+        fetched, delays = self.run_loop(30)
+        self.assertEqual(delays, [15] * 10)
+        self.assertEqual(fetched, 10)
+
+    def test_nearly_expired_tokens_dont_spin(self):
+        fetched, delays = self.run_loop(0.001)
+        self.assertEqual(fetched, 10)
+        self.assertTrue(all(delay >= MIN_REFRESH_INTERVAL for delay in delays[1:]))
+
+    def test_expired_tokens_dont_spin(self):
+        fetched, delays = self.run_loop(-5)
+        self.assertEqual(fetched, 10)
+        self.assertTrue(all(delay >= MIN_REFRESH_INTERVAL for delay in delays[1:]))
+
+    def test_no_refresh_margin_only_refreshes_on_demand(self):
+        fetched, delays = self.run_loop(30, refresh_margin=0)
+        self.assertEqual((fetched, delays), (1, []))
+
+if __name__ == '__main__':
+    unittest.main()